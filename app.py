@@ -1,56 +1,686 @@
 import os
-from flask import Flask, request, abort, jsonify
+import base64
+import json
+import operator
+import re
+from datetime import datetime
+from functools import wraps
+from flask import (Flask, Response, request, abort, jsonify, current_app,
+                   make_response, stream_with_context, url_for)
+from flask import json as flask_json
 from flask_cors import CORS
-
-from models import setup_db, Movie, Actor
-from auth import AuthError, requires_auth
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import (db, setup_db, get_versions, row_count, estimate_rows,
+                    estimate_table_rows, search, related_rows,
+                    add_cast_member, remove_cast_member, Movie, Actor)
+from auth import AuthError, requires_auth, setup_auth
+from cache import read_tables, response_cache
+from metrics import request_metrics
+from pool import pool_stats
+from querylog import query_budget, query_log
 
 ITEMS_PER_PAGE = 5
+MAX_ITEMS_PER_PAGE = 100
+MAX_BULK_ITEMS = 10000
+MAX_BULK_IDS = 1000
+EXPORT_BATCH_SIZE = 1000
+# Range of a BIGINT, and so of any ID, page or offset the database holds
+MIN_INTEGER = -2**63
+MAX_INTEGER = 2**63 - 1
+
+# Query parameters accepted as filters by the list endpoints, each
+# mapped to the column, comparison and conversion of the value
+ACTOR_FILTERS = {
+    'name': (Actor.name, operator.eq, str),
+    'gender': (Actor.gender, operator.eq, str),
+    'min_age': (Actor.age, operator.ge, int),
+    'max_age': (Actor.age, operator.le, int)
+}
+MOVIE_FILTERS = {
+    'title': (Movie.title, operator.eq, str),
+    'released_after': (Movie.release_date, operator.ge,
+                       datetime.fromisoformat),
+    'released_before': (Movie.release_date, operator.le,
+                        datetime.fromisoformat)
+}
+
+# Related rows the list endpoints can add with ?include=, each mapped
+# to the tables they are read from
+ACTOR_INCLUDES = {'movies': ('cast_members', 'movies')}
+MOVIE_INCLUDES = {'cast': ('cast_members', 'actors')}
+
+# Columns the list endpoints can be sorted by with ?sort=
+ACTOR_SORTS = {
+    'id': Actor.id,
+    'name': Actor.name,
+    'age': Actor.age,
+    'gender': Actor.gender
+}
+MOVIE_SORTS = {
+    'id': Movie.id,
+    'title': Movie.title,
+    'release_date': Movie.release_date
+}
+
+
+def encode_cursor(last_id):
+    '''Encodes the ID of the last item on a page as an opaque cursor.'''
+    cursor = base64.urlsafe_b64encode(f'id:{last_id}'.encode())
+    return cursor.decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''Decodes a cursor created by encode_cursor back into an ID.
+
+    Raises:
+        ValueError if the cursor is malformed or its ID out of range.
+    '''
+    padding = '=' * (-len(cursor) % 4)
+    try:
+        decoded = base64.urlsafe_b64decode(cursor + padding).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError(f'Invalid cursor: {cursor}')
+
+    prefix, _, last_id = decoded.partition(':')
+    if prefix != 'id' or not last_id.isdigit():
+        raise ValueError(f'Invalid cursor: {cursor}')
+    if not 1 <= int(last_id) <= MAX_INTEGER:
+        raise ValueError(f'Cursor out of range: {cursor}')
+
+    return int(last_id)
+
+
+def conditional(*table_names, includes=None):
+    '''Decorator adding ETags and conditional GET to a read route.
+
+    The ETag is derived from the versions of the tables the route
+    reads, which every write bumps. A request whose If-None-Match
+    matches gets a 304 after a single version lookup, without the
+    route loading or serializing any rows. includes maps ?include=
+    values to the extra tables they make the route read.
+    '''
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            tables = read_tables(table_names, includes)
+            versions = get_versions(*tables)
+            etag = '-'.join(f'{name}.{versions[name]}' for name in tables)
+
+            # Proxies that compress responses weaken the ETag, so
+            # If-None-Match is compared weakly, as RFC 7232 requires
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+
+        return wrapper
+
+    return conditional_decorator
+
+
+def is_filtered(request, filters):
+    '''Whether the query string has any of the filters.'''
+    return any(name in request.args for name in filters)
+
+
+def filter_query(request, selection, filters):
+    '''Applies the whitelisted filters in the query string.
+
+    Args:
+        request: the current request.
+        selection: the select to filter.
+        filters: dict of parameter names to (column, comparison,
+            conversion) tuples.
+
+    Returns:
+        The select with a WHERE clause for each filter given.
+
+    Raises:
+        400 if a filter value cannot be converted.
+    '''
+    for name, (column, compare, convert) in filters.items():
+        if name not in request.args:
+            continue
+        try:
+            value = convert(request.args[name])
+        except ValueError:
+            abort(400)
+        selection = selection.where(compare(column, value))
 
+    return selection
 
-def paginate(request, selection):
+
+def sort_order(request, sorts):
+    '''Parses ?sort=name,-age into ORDER BY clauses.
+
+    Columns prefixed with - are sorted in descending order.
+
+    Returns:
+        A list of ORDER BY clauses, empty if there is no ?sort.
+
+    Raises:
+        400 if a column cannot be sorted by.
+    '''
+    order = []
+    for name in request.args.get('sort', '').split(','):
+        if not name:
+            continue
+        descending = name.startswith('-')
+        column = sorts.get(name.lstrip('-'))
+        if column is None:
+            abort(400)
+        order.append(column.desc() if descending else column.asc())
+
+    return order
+
+
+def select_fields(request, model):
+    '''Parses ?fields=id,name into the column names to return.
+
+    Returns:
+        The list of column names, or None to return every column.
+
+    Raises:
+        400 if a field is not a column of the model.
+    '''
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+
+    names = [name for name in fields.split(',') if name]
+    columns = model.__table__.c
+    if not names or any(name not in columns for name in names):
+        abort(400)
+
+    return names
+
+
+def select_includes(request, includes):
+    '''Parses ?include=cast into the related rows to add to each item.
+
+    Returns:
+        The list of names to include, empty if there is no ?include.
+
+    Raises:
+        400 if a name cannot be included.
+    '''
+    names = [
+        name for name in request.args.get('include', '').split(',') if name
+    ]
+    if any(name not in includes for name in names):
+        abort(400)
+
+    return names
+
+
+def count_items(request, selection, table, filtered):
+    '''Counts the items of a list without scanning it where possible.
+
+    An unfiltered list is counted by the row count maintained in
+    table_versions, falling back to SELECT count(*) within the same
+    query for tables that are not counted. With ?count=estimate the
+    count comes from the planner statistics instead, for filtered
+    lists too, and is only approximate. Filtered lists are otherwise
+    counted with SELECT count(*).
+
+    Raises:
+        400 if ?count is neither exact nor estimate.
+    '''
+    mode = request.args.get('count', 'exact')
+    if mode not in ('exact', 'estimate'):
+        abort(400)
+
+    if mode == 'estimate':
+        total = (estimate_rows(selection)
+                 if filtered else estimate_table_rows(table.name))
+        if total is not None:
+            return total
+
+    count = selection.with_only_columns([func.count()]).select_from(
+        table).order_by(None)
+    if not filtered:
+        # COALESCE only runs the count(*) if the row count is NULL
+        count = select([func.coalesce(row_count(table.name),
+                                      count.as_scalar())])
+    return db.session.execute(count).scalar()
+
+
+def paginate(request,
+             selection,
+             key,
+             order=None,
+             fields=None,
+             include=None,
+             filtered=False):
+    '''Paginates a Core select in SQL.
+
+    Supports offset pagination with ?page=N and keyset pagination
+    with ?after=<cursor>. Both accept ?limit=N, capped at the
+    MAX_ITEMS_PER_PAGE config value. Only one page of rows, plus one
+    row to detect whether another page follows, is loaded. Keyset
+    pagination is only available in key order. The total is counted
+    by count_items.
+
+    Rows are read as plain result tuples and formatted straight into
+    dicts, so no ORM instances or identity map entries are created.
+
+    Args:
+        request: the current request.
+        selection: the select to paginate.
+        key: the unique column the pages are ordered by.
+        order: optional ORDER BY clauses to sort by before the key.
+        fields: optional column names to load and return, instead
+            of every column.
+        include: optional names to add the related rows of each item
+            under, all loaded with one query per page.
+        filtered: whether selection has a filter on top of the whole
+            table.
+
+    Returns:
+        A dict with the current page, total number of items, the
+        formatted items on the page and the cursor for the next page.
+
+    Raises:
+        400 if the page, limit, cursor or count mode is invalid.
+    '''
     page = request.args.get('page', 1, type=int)
-    start = (page - 1) * ITEMS_PER_PAGE
-    end = start + ITEMS_PER_PAGE
-
-    all_items = [item.format() for item in selection]
-    current_items = all_items[start:end]
+    limit = request.args.get('limit',
+                             current_app.config['ITEMS_PER_PAGE'],
+                             type=int)
+    cursor = request.args.get('after')
+
+    if page < 1 or limit < 1:
+        abort(400)
+    limit = min(limit, current_app.config['MAX_ITEMS_PER_PAGE'])
+    # The database cannot hold a larger offset
+    if (page - 1) * limit > MAX_INTEGER:
+        abort(400)
+
+    if cursor is not None:
+        if order:
+            abort(400)
+        try:
+            after_id = decode_cursor(cursor)
+        except ValueError:
+            abort(400)
+        page = None
+        page_query = selection.where(key > after_id).order_by(key)
+    else:
+        page_query = selection.order_by(*(order or []),
+                                        key).offset((page - 1) * limit)
+
+    model = key.class_
+    table = model.__table__
+    if fields is not None:
+        # Only the requested columns, plus the key for the cursor
+        columns = [table.c[key.key]] + [
+            table.c[name] for name in fields if name != key.key
+        ]
+        page_query = page_query.with_only_columns(columns)
+
+    items = db.session.execute(page_query.limit(limit + 1)).fetchall()
+    has_next = len(items) > limit
+    items = items[:limit]
+
+    next_cursor = None
+    if has_next and not order:
+        next_cursor = encode_cursor(items[-1][key.key])
+
+    total_items = count_items(request, selection, table, filtered)
+
+    current_items = [model.format_row(item, fields) for item in items]
+    if include:
+        related = related_rows(model, [item[key.key] for item in items])
+        for name in include:
+            for item, formatted in zip(items, current_items):
+                formatted[name] = related[item[key.key]]
 
     return {
         'current_page': page,
-        'total_items': len(all_items),
-        'current_items': current_items
+        'total_items': total_items,
+        'current_items': current_items,
+        'next_cursor': next_cursor
+    }
+
+
+def read_bulk_items(request):
+    '''Reads the items of a bulk request.
+
+    The body is either a JSON array or, with the application/x-ndjson
+    content type, one JSON object per line. Lines that are not valid
+    JSON are returned as None so they are reported as invalid items.
+
+    Raises:
+        400 if the body is not a JSON array or NDJSON.
+        413 if there are more than MAX_BULK_ITEMS items.
+    '''
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            abort(400)
+
+    if len(items) > current_app.config['MAX_BULK_ITEMS']:
+        abort(413)
+
+    return items
+
+
+def read_ids(request):
+    '''Reads the IDs of a bulk request from ?ids=1,2,3.
+
+    Returns:
+        The distinct IDs, in the order they were given.
+
+    Raises:
+        400 if there are no IDs or one is not an integer the database
+            can hold.
+        413 if there are more than MAX_BULK_IDS IDs.
+    '''
+    ids = []
+    for value in request.args.getlist('ids'):
+        for part in value.split(','):
+            try:
+                ids.append(int(part))
+            except ValueError:
+                abort(400)
+            if not MIN_INTEGER <= ids[-1] <= MAX_INTEGER:
+                abort(400)
+
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        abort(400)
+    if len(ids) > current_app.config['MAX_BULK_IDS']:
+        abort(413)
+
+    return ids
+
+
+def actor_type_error(details):
+    '''Returns an error message for the first actor field of a wrong
+    type, or None if every field given is valid.
+    '''
+    if 'name' in details and not isinstance(details['name'], str):
+        return 'name must be a string'
+    if 'age' in details and (not isinstance(details['age'], int)
+                             or isinstance(details['age'], bool)):
+        return 'age must be an integer'
+    if 'gender' in details and not isinstance(details['gender'], str):
+        return 'gender must be a string'
+    return None
+
+
+def validate_actor(details):
+    '''Validates the details of a new actor.
+
+    Returns:
+        A tuple of the row to insert and an error message, one of
+        which is None.
+    '''
+    if not isinstance(details, dict):
+        return None, 'item must be a JSON object'
+
+    missing = [key for key in ('name', 'age', 'gender') if key not in details]
+    if missing:
+        return None, f'missing {", ".join(missing)}'
+    error = actor_type_error(details)
+    if error:
+        return None, error
+
+    return {
+        'name': details['name'],
+        'age': details['age'],
+        'gender': details['gender']
+    }, None
+
+
+def validate_actor_update(details):
+    '''Validates the ID and new details of an actor to update.
+
+    Returns:
+        A tuple of the ID and columns to update and an error message,
+        one of which is None.
+    '''
+    if not isinstance(details, dict):
+        return None, 'item must be a JSON object'
+
+    if not isinstance(details.get('id'), int) or isinstance(
+            details['id'], bool):
+        return None, 'id must be an integer'
+    if not MIN_INTEGER <= details['id'] <= MAX_INTEGER:
+        return None, 'id is out of range'
+    values = {
+        key: details[key]
+        for key in ('name', 'age', 'gender') if key in details
     }
+    if not values:
+        return None, 'missing name, age or gender'
+    error = actor_type_error(values)
+    if error:
+        return None, error
+
+    return dict(values, id=details['id']), None
+
+
+def validate_movie(details):
+    '''Validates the details of a new movie.
+
+    Returns:
+        A tuple of the row to insert and an error message, one of
+        which is None.
+    '''
+    if not isinstance(details, dict):
+        return None, 'item must be a JSON object'
+
+    missing = [key for key in ('title', 'release_date') if key not in details]
+    if missing:
+        return None, f'missing {", ".join(missing)}'
+    if not isinstance(details['title'], str):
+        return None, 'title must be a string'
+    try:
+        release_date = datetime.fromisoformat(details['release_date'])
+    except (TypeError, ValueError):
+        return None, 'release_date must be an ISO 8601 date'
+
+    return {'title': details['title'], 'release_date': release_date}, None
+
+
+def bulk_create(model, items, validate):
+    '''Validates items and inserts the valid ones in one transaction.
+
+    Returns:
+        A JSON response with the ID of each created item and the
+        error for each invalid item, both by index in the request.
+
+    Raises:
+        422 if the valid items cannot be inserted.
+    '''
+    rows = []
+    indexes = []
+    errors = []
+    for index, details in enumerate(items):
+        row, error = validate(details)
+        if error:
+            errors.append({'index': index, 'message': error})
+        else:
+            rows.append(row)
+            indexes.append(index)
+
+    if not rows:
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'unprocessable',
+            'errors': errors
+        }), 422
+
+    try:
+        ids = model.bulk_insert(rows)
+    except SQLAlchemyError:
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'created': [{
+            'index': index,
+            'id': id
+        } for index, id in zip(indexes, ids)],
+        'errors': errors,
+        'total_created': len(ids)
+    })
+
+
+def bulk_patch(model, items, validate):
+    '''Validates updates and applies the valid ones in one transaction.
+
+    Returns:
+        A JSON response with each updated row, the IDs that have no
+        row and the error for each invalid item, by index in the
+        request.
+
+    Raises:
+        422 if the valid updates cannot be applied.
+    '''
+    updates = []
+    errors = []
+    seen = set()
+    for index, details in enumerate(items):
+        update, error = validate(details)
+        if not error and update['id'] in seen:
+            error = f'duplicate id {update["id"]}'
+        if error:
+            errors.append({'index': index, 'message': error})
+        else:
+            updates.append(update)
+            seen.add(update['id'])
+
+    if not updates:
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'unprocessable',
+            'errors': errors
+        }), 422
+
+    try:
+        updated = model.bulk_update(updates)
+    except SQLAlchemyError:
+        abort(422)
+
+    updated_ids = {row['id'] for row in updated}
+    return jsonify({
+        'success': True,
+        'updated': updated,
+        'not_found': [
+            update['id'] for update in updates
+            if update['id'] not in updated_ids
+        ],
+        'errors': errors,
+        'total_updated': len(updated)
+    })
+
+
+def export_ndjson(model):
+    '''Streams every row of a model's table, by ID, as NDJSON.
+
+    Rows are read through a server-side cursor EXPORT_BATCH_SIZE at a
+    time, so memory use does not grow with the table and the first
+    line is sent as soon as the first batch arrives. Each row is
+    formatted from its result tuple, without loading ORM instances.
+
+    Returns:
+        A streaming application/x-ndjson response.
+    '''
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    table = model.__table__
+    result = db.session.execute(
+        table.select().order_by(
+            table.c.id).execution_options(stream_results=True))
+
+    def generate():
+        for rows in iter(lambda: result.fetchmany(batch_size), []):
+            yield ''.join(
+                flask_json.dumps(model.format_row(row)) + '\n'
+                for row in rows)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
 
 
 def create_app(test_config=None):
     # Create and configure the app
     app = Flask(__name__)
+    app.config.from_mapping(
+        DATABASE_URL=os.environ.get('DATABASE_URL'),
+        ITEMS_PER_PAGE=int(os.environ.get('ITEMS_PER_PAGE', ITEMS_PER_PAGE)),
+        MAX_ITEMS_PER_PAGE=int(
+            os.environ.get('MAX_ITEMS_PER_PAGE', MAX_ITEMS_PER_PAGE)),
+        MAX_BULK_ITEMS=int(os.environ.get('MAX_BULK_ITEMS', MAX_BULK_ITEMS)),
+        MAX_BULK_IDS=int(os.environ.get('MAX_BULK_IDS', MAX_BULK_IDS)),
+        EXPORT_BATCH_SIZE=int(
+            os.environ.get('EXPORT_BATCH_SIZE', EXPORT_BATCH_SIZE)))
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     CORS(app)
     setup_db(app)
+    setup_auth(app)
+    response_cache.init_app(app)
+    request_metrics.init_app(app)
+    query_log.init_app(app)
 
     @app.route('/actors')
+    @query_budget(4)
+    @response_cache.cached('actors', includes=ACTOR_INCLUDES)
+    @conditional('actors', includes=ACTOR_INCLUDES)
     def get_actors():
         '''Handles GET requests for actors.
 
-        Accepts a request for actors and retrieves all actors
-        from the database.
+        Accepts a request for actors and retrieves one page of
+        actors from the database, either by ?page=N or by the
+        ?after=<cursor> returned with the previous page. Actors can
+        be filtered by gender, min_age/max_age or name and
+        sorted with ?sort=name,-age. ?fields=id,name loads and returns
+        only the listed columns, and ?include=movies adds the movies
+        each actor is cast in. ?count=estimate returns an estimated
+        total from the planner statistics.
 
         Returns:
             A JSON response reporting success, a list of actors as
-            JSON objects, total number of actors and current page.
+            JSON objects, total number of actors, current page and
+            the cursor for the next page.
 
         Raises:
+            400 if the page, limit, cursor, a filter, the sort order,
+                the fields, the include or the count mode are invalid.
             404 if there are no actors to return.
             422 if the request cannot be processed
         '''
         try:
-            actors = Actor.query.order_by(Actor.id).all()
-        except:
+            current_actors = paginate(
+                request, filter_query(request, Actor.__table__.select(),
+                                      ACTOR_FILTERS),
+                Actor.id, sort_order(request, ACTOR_SORTS),
+                select_fields(request, Actor),
+                select_includes(request, ACTOR_INCLUDES),
+                is_filtered(request, ACTOR_FILTERS))
+        except SQLAlchemyError:
             abort(422)
 
-        current_actors = paginate(request, actors)
-
         if len(current_actors['current_items']) == 0:
             abort(404)
 
@@ -58,31 +688,48 @@ def create_app(test_config=None):
             'success': True,
             'actors': current_actors['current_items'],
             'total_actors': current_actors['total_items'],
-            'current_page': current_actors['current_page']
+            'current_page': current_actors['current_page'],
+            'next_cursor': current_actors['next_cursor']
         })
 
     @app.route('/movies')
+    @query_budget(4)
+    @response_cache.cached('movies', includes=MOVIE_INCLUDES)
+    @conditional('movies', includes=MOVIE_INCLUDES)
     def get_movies():
         '''Handles GET requests for movies.
 
-        Accepts a request for movies and retrieves all movies
-        from the database.
+        Accepts a request for movies and retrieves one page of
+        movies from the database, either by ?page=N or by the
+        ?after=<cursor> returned with the previous page. Movies can
+        be filtered by title, released_after or released_before and
+        sorted with ?sort=-release_date. ?fields=id,title loads and
+        returns only the listed columns, and ?include=cast adds the
+        actors cast in each movie. ?count=estimate returns an
+        estimated total from the planner statistics.
 
         Returns:
             A JSON response reporting success, a list of movies as
-            JSON objects, total number of movies and current page.
+            JSON objects, total number of movies, current page and
+            the cursor for the next page.
 
         Raises:
+            400 if the page, limit, cursor, a filter, the sort order,
+                the fields, the include or the count mode are invalid.
             404 if there are no movies to return.
             422 if the request cannot be processed
         '''
         try:
-            movies = Movie.query.order_by(Movie.id).all()
-        except:
+            current_movies = paginate(
+                request, filter_query(request, Movie.__table__.select(),
+                                      MOVIE_FILTERS),
+                Movie.id, sort_order(request, MOVIE_SORTS),
+                select_fields(request, Movie),
+                select_includes(request, MOVIE_INCLUDES),
+                is_filtered(request, MOVIE_FILTERS))
+        except SQLAlchemyError:
             abort(404)
 
-        current_movies = paginate(request, movies)
-
         if len(current_movies['current_items']) == 0:
             abort(404)
 
@@ -90,16 +737,244 @@ def create_app(test_config=None):
             'success': True,
             'movies': current_movies['current_items'],
             'total_movies': current_movies['total_items'],
-            'current_page': current_movies['current_page']
+            'current_page': current_movies['current_page'],
+            'next_cursor': current_movies['next_cursor']
         })
 
+    @app.route('/search')
+    @query_budget(5)
+    @response_cache.cached('actors', 'movies')
+    @conditional('actors', 'movies')
+    def search_catalog():
+        '''Handles GET requests searching movies and actors.
+
+        Accepts a request with the words to search for in ?q= and
+        matches them against movie titles and actor names, by word
+        prefix and, on PostgreSQL with pg_trgm, by similarity. The
+        search can be narrowed with ?type=movies or ?type=actors.
+
+        Returns:
+            A JSON response reporting success and lists of movies and
+            actors as JSON objects, most relevant first.
+
+        Raises:
+            400 if there are no words to search for or the type or
+                limit is invalid.
+            422 if the request cannot be processed
+        '''
+        text = request.args.get('q', '')
+        kind = request.args.get('type')
+        limit = request.args.get('limit',
+                                 current_app.config['ITEMS_PER_PAGE'],
+                                 type=int)
+
+        if not re.search(r'\w', text) or limit < 1:
+            abort(400)
+        if kind not in (None, 'movies', 'actors'):
+            abort(400)
+        limit = min(limit, current_app.config['MAX_ITEMS_PER_PAGE'])
+
+        results = {'success': True, 'query': text}
+        try:
+            if kind in (None, 'movies'):
+                results['movies'] = search(Movie, text, limit)
+            if kind in (None, 'actors'):
+                results['actors'] = search(Actor, text, limit)
+        except SQLAlchemyError:
+            abort(422)
+
+        return jsonify(results)
+
+    @app.route('/actors/<int:id>')
+    @query_budget(2)
+    @response_cache.cached('actors')
+    @conditional('actors')
+    def get_actor(id):
+        '''Handles GET requests for a single actor.
+
+        Returns:
+            A JSON response reporting success and the actor as a
+            JSON object.
+
+        Raises:
+            404 if the specified actor does not exist.
+        '''
+        actor = Actor.get_row(id)
+
+        if actor is None:
+            abort(404)
+
+        return jsonify({'success': True, 'actor': actor})
+
+    @app.route('/movies/<int:id>')
+    @query_budget(2)
+    @response_cache.cached('movies')
+    @conditional('movies')
+    def get_movie(id):
+        '''Handles GET requests for a single movie.
+
+        Returns:
+            A JSON response reporting success and the movie as a
+            JSON object.
+
+        Raises:
+            404 if the specified movie does not exist.
+        '''
+        movie = Movie.get_row(id)
+
+        if movie is None:
+            abort(404)
+
+        return jsonify({'success': True, 'movie': movie})
+
+    @app.route('/movies/<int:id>/cast')
+    @query_budget(3)
+    @response_cache.cached('movies', 'cast_members', 'actors')
+    @conditional('movies', 'cast_members', 'actors')
+    def get_movie_cast(id):
+        '''Handles GET requests for the cast of a movie.
+
+        Returns:
+            A JSON response reporting success, the movie and the
+            actors cast in it as JSON objects.
+
+        Raises:
+            404 if the specified movie does not exist.
+        '''
+        movie = Movie.get_row(id)
+
+        if movie is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'movie': movie,
+            'cast': related_rows(Movie, [id])[id]
+        })
+
+    @app.route('/actors/<int:id>/movies')
+    @query_budget(3)
+    @response_cache.cached('actors', 'cast_members', 'movies')
+    @conditional('actors', 'cast_members', 'movies')
+    def get_actor_movies(id):
+        '''Handles GET requests for the movies an actor is cast in.
+
+        Returns:
+            A JSON response reporting success, the actor and their
+            movies as JSON objects.
+
+        Raises:
+            404 if the specified actor does not exist.
+        '''
+        actor = Actor.get_row(id)
+
+        if actor is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'actor': actor,
+            'movies': related_rows(Actor, [id])[id]
+        })
+
+    @app.route('/movies/<int:id>/cast', methods=['POST'])
+    @query_budget(7)
+    @requires_auth(permission='patch:movies')
+    def post_movie_cast(jwt, id):
+        '''Handles POST requests adding an actor to a movie's cast.
+
+        Accepts a JSON object with the actor_id to cast. Casting an
+        actor who is already in the cast changes nothing.
+
+        Returns:
+            A JSON response reporting success and the cast of the
+            movie as JSON objects.
+
+        Raises:
+            404 if the specified movie or actor does not exist.
+            422 if the request cannot be processed
+        '''
+        details = request.get_json(silent=True)
+        if not isinstance(details, dict):
+            abort(422)
+
+        actor_id = details.get('actor_id')
+        # bool is a subclass of int, but true is no actor ID
+        if not isinstance(actor_id, int) or isinstance(actor_id, bool):
+            abort(422)
+
+        if Movie.get_row(id) is None:
+            abort(404)
+        if Actor.get_row(actor_id) is None:
+            abort(404)
+
+        try:
+            add_cast_member(id, actor_id)
+            cast = related_rows(Movie, [id])[id]
+        except SQLAlchemyError:
+            abort(422)
+
+        return jsonify({'success': True, 'cast': cast})
+
+    @app.route('/movies/<int:id>/cast/<int:actor_id>', methods=['DELETE'])
+    @query_budget(3)
+    @requires_auth(permission='patch:movies')
+    def delete_movie_cast(jwt, id, actor_id):
+        '''Handles DELETE requests removing an actor from a cast.
+
+        Returns:
+            A JSON response reporting success and the ID of the
+            actor removed from the cast.
+
+        Raises:
+            404 if the actor is not in the cast of the movie.
+            422 if the request cannot be processed
+        '''
+        try:
+            deleted = remove_cast_member(id, actor_id)
+        except SQLAlchemyError:
+            abort(422)
+
+        if not deleted:
+            abort(404)
+
+        return jsonify({'success': True, 'delete': actor_id})
+
+    @app.route('/actors/export')
+    @query_budget(1)
+    def export_actors():
+        '''Handles GET requests for an export of all actors.
+
+        Streams every actor in the database, ordered by ID, as one
+        JSON object per line.
+
+        Returns:
+            A streaming NDJSON response of actors as JSON objects.
+        '''
+        return export_ndjson(Actor)
+
+    @app.route('/movies/export')
+    @query_budget(1)
+    def export_movies():
+        '''Handles GET requests for an export of all movies.
+
+        Streams every movie in the database, ordered by ID, as one
+        JSON object per line.
+
+        Returns:
+            A streaming NDJSON response of movies as JSON objects.
+        '''
+        return export_ndjson(Movie)
+
     @app.route('/actors/<int:id>', methods=['DELETE'])
+    @query_budget(3)
     @requires_auth(permission='delete:actors')
     def delete_actor(jwt, id):
         '''Handles DELETE requests for actors.
 
         Accepts a delete request for a specified actor
-        and deletes it from the database.
+        and deletes it from the database with a single DELETE
+        statement, without loading it first.
 
         Returns:
             A JSON response reporting success and the
@@ -109,25 +984,25 @@ def create_app(test_config=None):
             404 if the specified actor does not exist.
             422 if the request cannot be processed
         '''
-        actor = Actor.query.get(id)
+        try:
+            deleted = Actor.delete_returning(id)
+        except SQLAlchemyError:
+            abort(422)
 
-        if not actor:
+        if not deleted:
             abort(404)
 
-        try:
-            actor.delete()
-
-            return jsonify({'success': True, 'delete': id})
-        except:
-            abort(422)
+        return jsonify({'success': True, 'delete': id})
 
     @app.route('/movies/<int:id>', methods=['DELETE'])
+    @query_budget(3)
     @requires_auth(permission='delete:movies')
     def delete_movie(jwt, id):
         '''Handles DELETE requests for movies.
 
         Accepts a delete request for a specified movie
-        and deletes it from the database.
+        and deletes it from the database with a single DELETE
+        statement, without loading it first.
 
         Returns:
             A JSON response reporting success and the
@@ -137,29 +1012,93 @@ def create_app(test_config=None):
             404 if the specified movie does not exist.
             422 if the request cannot be processed
         '''
-        movie = Movie.query.get(id)
+        try:
+            deleted = Movie.delete_returning(id)
+        except SQLAlchemyError:
+            abort(422)
 
-        if not movie:
+        if not deleted:
             abort(404)
 
+        return jsonify({'success': True, 'delete': id})
+
+    @app.route('/actors', methods=['DELETE'])
+    @query_budget(4)
+    @requires_auth(permission='delete:actors')
+    def delete_actors(jwt):
+        '''Handles bulk DELETE requests for actors.
+
+        Deletes the actors given by ?ids=1,2,3 with a single DELETE
+        statement in one transaction.
+
+        Returns:
+            A JSON response reporting success, the IDs of the deleted
+            actors and the IDs that did not match any actor.
+
+        Raises:
+            400 if ?ids is missing or not a list of integers.
+            413 if there are too many IDs in the request.
+            422 if the request cannot be processed
+        '''
+        ids = read_ids(request)
         try:
-            movie.delete()
+            deleted = Actor.bulk_delete(ids)
+        except SQLAlchemyError:
+            abort(422)
 
-            return jsonify({'success': True, 'delete': id})
-        except:
+        found = set(deleted)
+        return jsonify({
+            'success': True,
+            'deleted': deleted,
+            'not_found': [id for id in ids if id not in found],
+            'total_deleted': len(deleted)
+        })
+
+    @app.route('/movies', methods=['DELETE'])
+    @query_budget(4)
+    @requires_auth(permission='delete:movies')
+    def delete_movies(jwt):
+        '''Handles bulk DELETE requests for movies.
+
+        Deletes the movies given by ?ids=1,2,3 with a single DELETE
+        statement in one transaction.
+
+        Returns:
+            A JSON response reporting success, the IDs of the deleted
+            movies and the IDs that did not match any movie.
+
+        Raises:
+            400 if ?ids is missing or not a list of integers.
+            413 if there are too many IDs in the request.
+            422 if the request cannot be processed
+        '''
+        ids = read_ids(request)
+        try:
+            deleted = Movie.bulk_delete(ids)
+        except SQLAlchemyError:
             abort(422)
 
+        found = set(deleted)
+        return jsonify({
+            'success': True,
+            'deleted': deleted,
+            'not_found': [id for id in ids if id not in found],
+            'total_deleted': len(deleted)
+        })
+
     @app.route('/actors', methods=['POST'])
+    @query_budget(5)
     @requires_auth(permission='post:actors')
     def post_actor(jwt):
         '''Handles POST requests for actors.
 
         Accepts a POST request for actors and adds the new
-        record to the database.
+        record to the database. With ?return=all the response also
+        lists every actor in the database, as it used to.
 
         Returns:
-            A JSON response reporting success, a list of all actors
-            as JSON objects, total number of actors & current page.
+            A JSON response reporting success and the new actor as a
+            JSON object, with a Location header pointing to it.
 
         Raises:
             422 if the request cannot be processed
@@ -180,25 +1119,32 @@ def create_app(test_config=None):
                               age=actor_age,
                               gender=actor_gender)
             new_actor.insert()
+            body = {'success': True, 'actor': new_actor.format()}
 
-            all_actors = Actor.query.all()
-            all_actors = [actor.format() for actor in all_actors]
+            if request.args.get('return') == 'all':
+                all_actors = Actor.query.all()
+                body['actors'] = [actor.format() for actor in all_actors]
         except:
             abort(422)
 
-        return jsonify({'success': True, 'actors': all_actors})
+        response = jsonify(body)
+        response.headers['Location'] = url_for('get_actor',
+                                               id=body['actor']['id'])
+        return response
 
     @app.route('/movies', methods=['POST'])
+    @query_budget(5)
     @requires_auth(permission='post:movies')
     def post_movie(jwt):
         '''Handles POST requests for movies.
 
         Accepts a POST request for movies and adds the new
-        record to the database.
+        record to the database. With ?return=all the response also
+        lists every movie in the database, as it used to.
 
         Returns:
-            A JSON response reporting success, a list of all movies
-            as JSON objects, total number of movies & current page.
+            A JSON response reporting success and the new movie as a
+            JSON object, with a Location header pointing to it.
 
         Raises:
             422 if the request cannot be processed
@@ -212,24 +1158,74 @@ def create_app(test_config=None):
         movie_release_date = movie_details['release_date']
 
         try:
-            new_movie = Movie(title=movie_title,
-                              release_date=movie_release_date)
+            new_movie = Movie(
+                title=movie_title,
+                release_date=datetime.fromisoformat(movie_release_date))
             new_movie.insert()
+            body = {'success': True, 'movie': new_movie.format()}
 
-            all_movies = Movie.query.all()
-            all_movies = [movie.format() for movie in all_movies]
+            if request.args.get('return') == 'all':
+                all_movies = Movie.query.all()
+                body['movies'] = [movie.format() for movie in all_movies]
         except:
             abort(422)
 
-        return jsonify({'success': True, 'movies': all_movies})
+        response = jsonify(body)
+        response.headers['Location'] = url_for('get_movie',
+                                               id=body['movie']['id'])
+        return response
+
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth(permission='post:actors')
+    def post_actors_bulk(jwt):
+        '''Handles bulk POST requests for actors.
+
+        Accepts a JSON array or NDJSON body of actors, validates
+        each one and adds the valid ones to the database in one
+        transaction.
+
+        Returns:
+            A JSON response reporting success, the index and ID of
+            each created actor and the index and error of each
+            invalid actor.
+
+        Raises:
+            400 if the body is not a JSON array or NDJSON.
+            413 if there are too many actors in the request.
+            422 if no actor is valid or they cannot be added.
+        '''
+        return bulk_create(Actor, read_bulk_items(request), validate_actor)
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth(permission='post:movies')
+    def post_movies_bulk(jwt):
+        '''Handles bulk POST requests for movies.
+
+        Accepts a JSON array or NDJSON body of movies, validates
+        each one and adds the valid ones to the database in one
+        transaction.
+
+        Returns:
+            A JSON response reporting success, the index and ID of
+            each created movie and the index and error of each
+            invalid movie.
+
+        Raises:
+            400 if the body is not a JSON array or NDJSON.
+            413 if there are too many movies in the request.
+            422 if no movie is valid or they cannot be added.
+        '''
+        return bulk_create(Movie, read_bulk_items(request), validate_movie)
 
     @app.route('/actors/<int:id>', methods=['PATCH'])
+    @query_budget(3)
     @requires_auth(permission='patch:actors')
     def patch_actor(jwt, id):
         '''Handles PATCH requests for actors.
 
         Accepts a PATCH request for a specified actor
-        and updates the record in the database.
+        and updates the record in the database with a single
+        UPDATE statement that also returns the updated record.
 
         Returns:
             A JSON response reporting success and the
@@ -239,41 +1235,66 @@ def create_app(test_config=None):
             404 if the specified actor does not exist.
             422 if the request cannot be processed
         '''
-        edit_actor = Actor.query.get(id)
-        if not edit_actor:
-            abort(404)
-
         actor_update = request.get_json()
-        if 'name' in actor_update:
-            actor_name = actor_update['name']
-            edit_actor.name = actor_name
-        if 'age' in actor_update:
-            actor_age = actor_update['age']
-            edit_actor.age = actor_age
-        if 'gender' in actor_update:
-            actor_gender = actor_update['gender']
-            edit_actor.gender = actor_gender
-        if 'name' not in actor_update:
-            if 'age' not in actor_update:
-                if 'gender' not in actor_update:
-                    abort(422)
+        if not isinstance(actor_update, dict):
+            abort(422)
 
-        try:
-            edit_actor.update()
-            actor = Actor.query.get(id)
-            actor = actor.format()
+        actor_values = {
+            key: actor_update[key]
+            for key in ('name', 'age', 'gender') if key in actor_update
+        }
+        if not actor_values:
+            abort(422)
+        error = actor_type_error(actor_values)
+        if error:
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': error
+            }), 422
 
-            return jsonify({'success': True, 'actors': actor})
-        except:
+        try:
+            actor = Actor.update_returning(id, actor_values)
+        except SQLAlchemyError:
             abort(422)
 
+        if actor is None:
+            abort(404)
+
+        return jsonify({'success': True, 'actors': actor})
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth(permission='patch:actors')
+    def patch_actors_bulk(jwt):
+        '''Handles bulk PATCH requests for actors.
+
+        Accepts a JSON array or NDJSON body of objects, each with
+        the id of an actor and the fields to change, and updates
+        the valid ones with set-based UPDATE statements in one
+        transaction.
+
+        Returns:
+            A JSON response reporting success, each updated actor,
+            the IDs that did not match any actor and the index and
+            error of each invalid item.
+
+        Raises:
+            400 if the body is not a JSON array or NDJSON.
+            413 if there are too many items in the request.
+            422 if no item is valid or they cannot be applied.
+        '''
+        return bulk_patch(Actor, read_bulk_items(request),
+                          validate_actor_update)
+
     @app.route('/movies/<int:id>', methods=['PATCH'])
+    @query_budget(3)
     @requires_auth(permission='patch:movies')
     def patch_movie(jwt, id):
         '''Handles PATCH requests for movies.
 
         Accepts a PATCH request for a specified movie
-        and updates the record in the database.
+        and updates the record in the database with a single
+        UPDATE statement that also returns the updated record.
 
         Returns:
             A JSON response reporting success and the
@@ -283,30 +1304,62 @@ def create_app(test_config=None):
             404 if the specified movie does not exist.
             422 if the request cannot be processed
         '''
-        edit_movie = Movie.query.get(id)
-        if not edit_movie:
-            abort(404)
-
         movie_update = request.get_json()
-        if 'title' in movie_update:
-            movie_title = movie_update['title']
-            edit_movie.title = movie_title
-        if 'release_date' in movie_update:
-            movie_release_date = movie_update['release_date']
-            edit_movie.release_date = movie_release_date
-        if 'title' not in movie_update:
-            if 'release_date' not in movie_update:
-                abort(422)
+        if not isinstance(movie_update, dict):
+            abort(422)
 
-        try:
-            edit_movie.update()
-            movie = Movie.query.get(id)
-            movie = movie.format()
+        movie_values = {
+            key: movie_update[key]
+            for key in ('title', 'release_date') if key in movie_update
+        }
+        if not movie_values:
+            abort(422)
+        if 'release_date' in movie_values:
+            try:
+                movie_values['release_date'] = datetime.fromisoformat(
+                    movie_values['release_date'])
+            except (TypeError, ValueError):
+                return jsonify({
+                    'success': False,
+                    'error': 422,
+                    'message': 'release_date must be an ISO 8601 date'
+                }), 422
 
-            return jsonify({'success': True, 'movies': movie})
-        except:
+        try:
+            movie = Movie.update_returning(id, movie_values)
+        except SQLAlchemyError:
             abort(422)
 
+        if movie is None:
+            abort(404)
+
+        return jsonify({'success': True, 'movies': movie})
+
+    @app.route('/cache/stats')
+    def get_cache_stats():
+        '''Handles GET requests for response cache statistics.
+
+        Returns:
+            A JSON response with the cache backend, number of
+            entries, hits, misses, hit ratio and evictions of the
+            worker that answered.
+        '''
+        return jsonify({'success': True, 'cache': response_cache.stats()})
+
+    @app.route('/pool/stats')
+    def get_pool_stats():
+        '''Handles GET requests for connection pool statistics.
+
+        Returns:
+            A JSON response with the pool size and connections in use,
+            checkouts, saturated checkouts, waits, timeouts and
+            checkout wait times of the worker that answered.
+        '''
+        return jsonify({
+            'success': True,
+            'pool': pool_stats.stats(db.engine.pool)
+        })
+
     # Error handling
     @app.errorhandler(400)
     def bad_request(error):
@@ -348,6 +1401,14 @@ def create_app(test_config=None):
             'message': 'method not allowed'
         }), 405
 
+    @app.errorhandler(413)
+    def too_large(error):
+        return jsonify({
+            'success': False,
+            'error': 413,
+            'message': 'payload too large'
+        }), 413
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -367,7 +1428,5 @@ def create_app(test_config=None):
     return app
 
 
-app = create_app()
-
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    create_app().run(host='0.0.0.0', port=8080, debug=True)
@@ -1,13 +1,55 @@
 import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
+from jose import jwk, jwt
 from urllib.request import urlopen
 import os
+import rsa
 
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = [os.environ['AUTH0_ALGORITHMS']]
-API_AUDIENCE = os.environ['AUTH0_AUDIENCE']
+from metrics import time_auth_verify
+
+# Issuer domain and audience of tokens for the offline key sources. Auth0
+# has no defaults: AUTH0_DOMAIN and AUTH0_AUDIENCE must be set for it.
+OFFLINE_DOMAIN = 'casting-agency.local'
+OFFLINE_AUDIENCE = 'casting-agency'
+
+# Defaults of the auth settings. setup_auth replaces them with the app
+# config, which reads them from environment variables of the same name.
+AUTH0_DOMAIN = OFFLINE_DOMAIN
+ALGORITHMS = ['RS256']
+API_AUDIENCE = OFFLINE_AUDIENCE
+
+# Where token signing keys come from: auth0, jwks_file or local
+AUTH_KEY_SOURCE = 'auth0'
+# JWKS document used when AUTH_KEY_SOURCE is jwks_file
+AUTH_JWKS_FILE = None
+# PEM private key used when AUTH_KEY_SOURCE is local, generated if unset
+AUTH_PRIVATE_KEY = None
+
+# Seconds before cached signing keys are refreshed in the background
+JWKS_TTL = 600
+# Minimum seconds between two fetches of the key set
+JWKS_MIN_REFRESH_INTERVAL = 30
+JWKS_FETCH_TIMEOUT = 5
+# Maximum number of verified tokens kept in memory, 0 disables the cache
+TOKEN_CACHE_SIZE = 1024
+
+# Permissions granted to each role in Auth0
+ROLE_PERMISSIONS = {
+    'assistant': ['get:actors', 'get:movies'],
+    'director': [
+        'get:actors', 'get:movies', 'post:actors', 'delete:actors',
+        'patch:actors', 'patch:movies'
+    ],
+    'producer': [
+        'get:actors', 'get:movies', 'post:actors', 'delete:actors',
+        'patch:actors', 'patch:movies', 'post:movies', 'delete:movies'
+    ]
+}
 
 # AuthError Exception
 '''
@@ -58,11 +100,298 @@ def get_token_auth_header():
     return auth_token
 
 
+# JWKS Store
+'''
+JWKSStore
+An in-process cache of the Auth0 JSON Web Key Set. The key set is
+fetched once, then refreshed in a background thread whenever it is
+older than the TTL. A token signed with an unknown key id (kid)
+forces a refresh, but at most once per min_refresh_interval so bad
+tokens cannot hammer the IdP. When a refresh fails the last good keys
+keep being served.
+'''
+
+
+class JWKSStore:
+    def __init__(self,
+                 url,
+                 ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self._loaded_at = None
+        self._last_attempt = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def fetch(self):
+        '''Downloads the key set and returns it as a dict.'''
+        with urlopen(self.url, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def refresh(self):
+        '''Reloads the keys, keeping the current ones on failure.
+
+        Returns:
+            True if the keys were reloaded, False otherwise.
+        '''
+        self._last_attempt = time.monotonic()
+        try:
+            jwks = self.fetch()
+            keys = {key['kid']: key for key in jwks['keys']}
+        except Exception:
+            self.refresh_failures += 1
+            return False
+
+        self.keys = keys
+        self._loaded_at = time.monotonic()
+        self.refreshes += 1
+        return True
+
+    def get_key(self, kid):
+        '''Returns the JWK with the given kid, or None if unknown.'''
+        if self._loaded_at is None:
+            with self._lock:
+                if self._loaded_at is None and self._may_refresh():
+                    self.refresh()
+        elif time.monotonic() - self._loaded_at > self.ttl:
+            self._refresh_in_background()
+
+        key = self.keys.get(kid)
+        if key is None:
+            with self._lock:
+                key = self.keys.get(kid)
+                if key is None and self._may_refresh():
+                    self.refresh()
+                    key = self.keys.get(kid)
+
+        if key is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return key
+
+    def is_loaded(self):
+        return self._loaded_at is not None
+
+    def stats(self):
+        return {
+            'keys': len(self.keys),
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'refresh_failures': self.refresh_failures
+        }
+
+    def _may_refresh(self):
+        return (self._last_attempt is None or time.monotonic() -
+                self._last_attempt >= self.min_refresh_interval)
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing or not self._may_refresh():
+                return
+            self._refreshing = True
+            self._last_attempt = time.monotonic()
+
+        def run():
+            try:
+                with self._lock:
+                    self.refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+class JWKSFileStore(JWKSStore):
+    '''JWKSStore that reads the key set from a local file.'''
+    def fetch(self):
+        with open(self.url) as jwks_file:
+            return json.load(jwks_file)
+
+
+# Local Key Pair
+'''
+LocalKeyPair
+An RSA key pair standing in for Auth0, so tokens can be minted and
+verified with no network access (tests, load runs, profiling). It
+answers get_key like a JWKSStore and signs tokens with the private key.
+A new key of `bits` bits is generated when no private key is given.
+'''
+
+
+class LocalKeyPair:
+    def __init__(self, private_key_pem=None, bits=2048):
+        if private_key_pem is None:
+            _, private_key = rsa.newkeys(bits)
+            private_key_pem = private_key.save_pkcs1().decode()
+
+        public_key = jwk.construct(private_key_pem, ALGORITHMS[0])
+        public_jwk = public_key.public_key().to_dict()
+
+        self.private_key_pem = private_key_pem
+        self.kid = hashlib.sha256(public_jwk['n'].encode()).hexdigest()[:16]
+        self.jwk = dict(public_jwk, kid=self.kid, use='sig')
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as key_file:
+            return cls(key_file.read())
+
+    def get_key(self, kid):
+        return self.jwk if kid == self.kid else None
+
+    def is_loaded(self):
+        return True
+
+    def jwks(self):
+        return {'keys': [self.jwk]}
+
+    def stats(self):
+        return {'keys': 1}
+
+    def sign(self, claims):
+        return jwt.encode(claims,
+                          self.private_key_pem,
+                          algorithm=ALGORITHMS[0],
+                          headers={'kid': self.kid})
+
+
+def create_key_source():
+    '''Builds the key source selected by AUTH_KEY_SOURCE.'''
+    if AUTH_KEY_SOURCE == 'local':
+        if AUTH_PRIVATE_KEY:
+            return LocalKeyPair.from_file(AUTH_PRIVATE_KEY)
+        return LocalKeyPair()
+
+    options = {
+        'ttl': JWKS_TTL,
+        'min_refresh_interval': JWKS_MIN_REFRESH_INTERVAL,
+        'timeout': JWKS_FETCH_TIMEOUT
+    }
+    if AUTH_KEY_SOURCE == 'jwks_file':
+        return JWKSFileStore(AUTH_JWKS_FILE, **options)
+    return JWKSStore(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json',
+                     **options)
+
+
+# Created on first use, so importing this module and building the app
+# never generate keys or touch the network
+key_source = None
+_key_source_lock = threading.Lock()
+
+
+def get_key_source():
+    '''Returns the key source, creating it from the settings if needed.'''
+    global key_source
+    if key_source is None:
+        with _key_source_lock:
+            if key_source is None:
+                key_source = create_key_source()
+    return key_source
+
+
+# Token Cache
+'''
+TokenCache
+A bounded LRU cache of tokens that already passed verification, keyed
+by the SHA-256 digest of the token so raw tokens are never held. Each
+entry stores the decoded payload and its permissions as a frozenset and
+lives until the token's exp claim, so a client reusing its bearer token
+skips signature and claim checks on every request after the first.
+'''
+
+
+class TokenCache:
+    def __init__(self, max_size=TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token):
+        '''Returns the cached (payload, permissions) or None.'''
+        digest = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, payload, permissions = entry
+            if expires_at <= time.time():
+                del self._entries[digest]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return payload, permissions
+
+    def put(self, token, payload):
+        '''Caches a verified payload until it expires.
+
+        Tokens without an exp claim are not cached.
+
+        Returns:
+            The (payload, permissions) pair for the token.
+        '''
+        permissions = None
+        if 'permissions' in payload:
+            permissions = frozenset(payload['permissions'])
+
+        expires_at = payload.get('exp')
+        if not self.max_size or not isinstance(expires_at, (int, float)):
+            return payload, permissions
+
+        with self._lock:
+            self._entries[self.digest(token)] = (expires_at, payload,
+                                                 permissions)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        return payload, permissions
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+token_cache = TokenCache()
 '''
     @INPUTS
         token: a json web token (string)
     it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
+    it should verify the token using Auth0 /.well-known/jwks.json,
+    served from key_source rather than fetched per request
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -70,8 +399,6 @@ def get_token_auth_header():
 
 
 def verify_decode_jwt(token):
-    jwks_url = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks_json = json.loads(jwks_url.read())
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
 
@@ -82,15 +409,23 @@ def verify_decode_jwt(token):
                 'description': 'Authorization malformed.'
             }, 401)
 
-    for key in jwks_json['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    source = get_key_source()
+    key = source.get_key(unverified_header['kid'])
+    if key is None and not source.is_loaded():
+        raise AuthError(
+            {
+                'code': 'jwks_unavailable',
+                'description': 'Unable to load the signing keys.'
+            }, 503)
+
+    if key:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
 
     if rsa_key:
         try:
@@ -130,10 +465,112 @@ def verify_decode_jwt(token):
         }, 400)
 
 
+def setup_auth(app):
+    '''Applies the AUTH0_* and AUTH_* settings of the app config.
+
+    Settings missing from the config are read from the environment
+    variables of the same name. A key source already in use is kept;
+    otherwise one is created from these settings on first use.
+
+    Raises:
+        RuntimeError if AUTH_KEY_SOURCE is auth0 and AUTH0_DOMAIN or
+            AUTH0_AUDIENCE is not set.
+    '''
+    global AUTH0_DOMAIN, ALGORITHMS, API_AUDIENCE, AUTH_KEY_SOURCE, \
+        AUTH_JWKS_FILE, AUTH_PRIVATE_KEY, JWKS_TTL, \
+        JWKS_MIN_REFRESH_INTERVAL, JWKS_FETCH_TIMEOUT
+
+    env = os.environ
+    config = {
+        'AUTH0_DOMAIN': env.get('AUTH0_DOMAIN'),
+        'AUTH0_ALGORITHMS': env.get('AUTH0_ALGORITHMS', ALGORITHMS[0]),
+        'AUTH0_AUDIENCE': env.get('AUTH0_AUDIENCE'),
+        'AUTH_KEY_SOURCE': env.get('AUTH_KEY_SOURCE', AUTH_KEY_SOURCE),
+        'AUTH_JWKS_FILE': env.get('AUTH_JWKS_FILE', AUTH_JWKS_FILE),
+        'AUTH_PRIVATE_KEY': env.get('AUTH_PRIVATE_KEY', AUTH_PRIVATE_KEY),
+        'AUTH0_JWKS_TTL': int(env.get('AUTH0_JWKS_TTL', JWKS_TTL)),
+        'AUTH0_JWKS_MIN_REFRESH_INTERVAL':
+        int(env.get('AUTH0_JWKS_MIN_REFRESH_INTERVAL',
+                    JWKS_MIN_REFRESH_INTERVAL)),
+        'AUTH0_JWKS_FETCH_TIMEOUT':
+        int(env.get('AUTH0_JWKS_FETCH_TIMEOUT', JWKS_FETCH_TIMEOUT)),
+        'AUTH_TOKEN_CACHE_SIZE':
+        int(env.get('AUTH_TOKEN_CACHE_SIZE', TOKEN_CACHE_SIZE))
+    }
+    for key, value in config.items():
+        app.config.setdefault(key, value)
+
+    config = app.config
+    if config['AUTH_KEY_SOURCE'] == 'auth0':
+        missing = [
+            key for key in ('AUTH0_DOMAIN', 'AUTH0_AUDIENCE')
+            if not config[key]
+        ]
+        if missing:
+            raise RuntimeError(
+                f'{" and ".join(missing)} must be set when AUTH_KEY_SOURCE '
+                'is auth0; use local or jwks_file for offline auth')
+
+    AUTH0_DOMAIN = config['AUTH0_DOMAIN'] or OFFLINE_DOMAIN
+    ALGORITHMS = [config['AUTH0_ALGORITHMS']]
+    API_AUDIENCE = config['AUTH0_AUDIENCE'] or OFFLINE_AUDIENCE
+    AUTH_KEY_SOURCE = config['AUTH_KEY_SOURCE']
+    AUTH_JWKS_FILE = config['AUTH_JWKS_FILE']
+    AUTH_PRIVATE_KEY = config['AUTH_PRIVATE_KEY']
+    JWKS_TTL = config['AUTH0_JWKS_TTL']
+    JWKS_MIN_REFRESH_INTERVAL = config['AUTH0_JWKS_MIN_REFRESH_INTERVAL']
+    JWKS_FETCH_TIMEOUT = config['AUTH0_JWKS_FETCH_TIMEOUT']
+    token_cache.max_size = config['AUTH_TOKEN_CACHE_SIZE']
+
+
+def set_key_source(source):
+    '''Replaces the key source used to verify tokens.
+
+    Any JWKSStore, JWKSFileStore or LocalKeyPair can be used. Cached
+    tokens verified with the previous keys are dropped. None goes back
+    to creating one from the settings on first use.
+    '''
+    global key_source
+    key_source = source
+    token_cache.clear()
+
+
+def mint_token(role, signer=None, expires_in=86400):
+    '''Mints a token carrying the same permission claims as Auth0.
+
+    Args:
+        role: one of the ROLE_PERMISSIONS roles.
+        signer: LocalKeyPair to sign with, defaults to key_source.
+        expires_in: seconds until the token expires.
+
+    Returns:
+        The signed token.
+
+    Raises:
+        KeyError if the role is unknown.
+        ValueError if the signer cannot sign tokens.
+    '''
+    signer = signer or get_key_source()
+    if not hasattr(signer, 'sign'):
+        raise ValueError('Tokens can only be minted with a LocalKeyPair.')
+
+    issued_at = int(time.time())
+    return signer.sign({
+        'iss': f'https://{AUTH0_DOMAIN}/',
+        'sub': f'local|{role}',
+        'aud': API_AUDIENCE,
+        'iat': issued_at,
+        'exp': issued_at + expires_in,
+        'permissions': ROLE_PERMISSIONS[role]
+    })
+
+
 '''
     @INPUTS
         permission: string permission (i.e. 'post:drink')
         payload: decoded jwt payload
+        permissions: optional set of the payload permissions, as
+            cached by token_cache, to check against instead
     it should raise an AuthError if permissions are not included
     in the payload
         !!NOTE check your RBAC settings in Auth0
@@ -143,15 +580,17 @@ def verify_decode_jwt(token):
 '''
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        raise AuthError(
-            {
-                'code': 'invalid_claims',
-                'description': 'Permissions not included in token.'
-            }, 400)
+def check_permissions(permission, payload, permissions=None):
+    if permissions is None:
+        if 'permissions' not in payload:
+            raise AuthError(
+                {
+                    'code': 'invalid_claims',
+                    'description': 'Permissions not included in token.'
+                }, 400)
+        permissions = payload['permissions']
 
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         raise AuthError(
             {
                 'code': 'unauthorized',
@@ -164,7 +603,8 @@ def check_permissions(permission, payload):
     @INPUTS
         permission: string permission (i.e. 'post:drink')
     it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
+    it should use the verify_decode_jwt method to decode the jwt,
+    unless the token is already in token_cache
     it should use the check_permissions method validate claims and
     check the requested permission
     return the decorator which passes the decoded payload to the
@@ -177,8 +617,13 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            cached = token_cache.get(token)
+            if cached is None:
+                with time_auth_verify():
+                    payload = verify_decode_jwt(token)
+                cached = token_cache.put(token, payload)
+            payload, permissions = cached
+            check_permissions(permission, payload, permissions)
             return f(payload, *args, **kwargs)
 
         return wrapper
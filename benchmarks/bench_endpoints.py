@@ -0,0 +1,513 @@
+'''Measures the latency and throughput of every endpoint of the API.
+
+Seeds actors, movies and their casts at the chosen scale, then drives
+each route of create_app() for a fixed time, first in-process through
+the Flask test client and then through a gunicorn server with
+concurrent keep-alive clients. Tokens are signed with a throwaway key
+pair whose JWKS document the app loads from a file, so no request
+reaches Auth0. For each endpoint it reports requests per second, p50,
+p95 and p99 latency and the peak RSS of the serving processes, and
+writes everything to a JSON file. Responses with a 4xx or 5xx status,
+e.g. from a rejected token or a row already deleted, are counted as
+errors and left out of the request rate and percentiles.
+
+Usage:
+    python benchmarks/bench_endpoints.py [--scale 1k|100k|1m|N]
+        [--duration S] [--clients N] [--workers N] [--threads N]
+        [--mode test_client|gunicorn|both] [--only ENDPOINT ...]
+        [--database-url URL] [--output FILE] [--compare FILE]
+
+Without --database-url a throwaway SQLite file is used. Another
+database must have been migrated and have no actors or movies; the
+seeded rows are deleted again afterwards. --compare prints the change
+of every endpoint against the results file of an earlier run.
+'''
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from bench_workers import PORT, client, percentile, wait_until_up
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+# Actors seeded into the cast of every movie
+CAST_SIZE = 3
+# Items sent by each request to the bulk endpoints
+BULK_SIZE = 100
+RSS_SAMPLE_INTERVAL = 0.05
+
+# Every route of create_app(), in the order they are run: reads first,
+# then writes, and deletes last so they do not thin out the data the
+# others read. Paths are formatted with the IDs of the n-th request:
+# {row} spreads requests over all rows, {last} walks down from the
+# highest ID, {cast_movie} and {cast_actor} name a seeded cast member
+# and {batch} lists BULK_SIZE consecutive IDs, different for every
+# request until they wrap around.
+ENDPOINTS = [
+    ('get_actors', 'GET', '/actors', None),
+    ('get_movies', 'GET', '/movies', None),
+    ('search_catalog', 'GET', '/search?q=Movie+{row}', None),
+    ('get_actor', 'GET', '/actors/{row}', None),
+    ('get_movie', 'GET', '/movies/{row}', None),
+    ('get_movie_cast', 'GET', '/movies/{row}/cast', None),
+    ('get_actor_movies', 'GET', '/actors/{row}/movies', None),
+    ('export_actors', 'GET', '/actors/export', None),
+    ('export_movies', 'GET', '/movies/export', None),
+    ('get_cache_stats', 'GET', '/cache/stats', None),
+    ('get_pool_stats', 'GET', '/pool/stats', None),
+    ('metrics', 'GET', '/metrics', None),
+    ('post_movie_cast', 'POST', '/movies/{row}/cast', 'cast'),
+    ('post_actor', 'POST', '/actors', 'actor'),
+    ('post_movie', 'POST', '/movies', 'movie'),
+    ('post_actors_bulk', 'POST', '/actors/bulk', 'actors'),
+    ('post_movies_bulk', 'POST', '/movies/bulk', 'movies'),
+    ('patch_actor', 'PATCH', '/actors/{row}', 'actor_update'),
+    ('patch_movie', 'PATCH', '/movies/{row}', 'movie_update'),
+    ('patch_actors_bulk', 'PATCH', '/actors/bulk', 'actors_update'),
+    ('delete_movie_cast', 'DELETE', '/movies/{cast_movie}/cast/{cast_actor}',
+     None),
+    ('delete_actor', 'DELETE', '/actors/{last}', None),
+    ('delete_movie', 'DELETE', '/movies/{last}', None),
+    ('delete_actors', 'DELETE', '/actors?ids={batch}', None),
+    ('delete_movies', 'DELETE', '/movies?ids={batch}', None)
+]
+
+
+def parse_scale(value):
+    try:
+        return SCALES.get(value.lower()) or int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'expected one of {", ".join(SCALES)} or a number of rows')
+
+
+def request_body(kind, number, row, batch):
+    if kind == 'cast':
+        return {'actor_id': row}
+    if kind == 'actor':
+        return {'name': f'Bench Actor {number}', 'age': 30, 'gender': 'f'}
+    if kind == 'movie':
+        return {'title': f'Bench Movie {number}', 'release_date': '2020-01-01'}
+    if kind == 'actors':
+        return [
+            request_body('actor', number, row, batch)
+            for _ in range(BULK_SIZE)
+        ]
+    if kind == 'movies':
+        return [
+            request_body('movie', number, row, batch)
+            for _ in range(BULK_SIZE)
+        ]
+    if kind == 'actor_update':
+        return {'age': 18 + number % 60}
+    if kind == 'actors_update':
+        return [
+            dict(request_body('actor_update', number, row, batch), id=id)
+            for id in batch
+        ]
+    return {'title': f'Movie {row} (cut {number})'}
+
+
+def endpoint_request(endpoint, scale, token, offset, stride, number):
+    '''Builds the number-th request of a client to an endpoint.
+
+    Clients take every stride-th request starting at offset, so
+    concurrent clients never delete the same row.
+    '''
+    _, method, path, kind = endpoint
+    number = offset + stride * number
+    row = number * 7919 % scale + 1
+    cast_movie = number % scale + 1
+    batch = [(number * BULK_SIZE + i) % scale + 1 for i in range(BULK_SIZE)]
+    path = path.format(row=row,
+                       last=scale - number % scale,
+                       cast_movie=cast_movie,
+                       cast_actor=(cast_movie + number // scale % CAST_SIZE) %
+                       scale + 1,
+                       batch=','.join(map(str, batch)))
+
+    headers = {'Authorization': f'Bearer {token}'}
+    body = None
+    if kind is not None:
+        body = json.dumps(request_body(kind, number, row, batch))
+        headers['Content-Type'] = 'application/json'
+    return method, path, body, headers
+
+
+def seed_records(scale, header, record):
+    yield f'id,{header}\n'
+    for i in range(1, scale + 1):
+        yield f'{i},{record(i)}\n'
+
+
+def seed(scale):
+    '''Loads scale actors and movies, and CAST_SIZE actors per movie.'''
+    import transfer
+    from sqlalchemy import func, select
+    from models import db, bump_version, cast_members, Actor, Movie
+
+    for model in (Actor, Movie):
+        count = db.session.execute(
+            select([func.count()]).select_from(model.__table__)).scalar()
+        if count:
+            raise SystemExit(f'{model.__tablename__} is not empty, use a '
+                             'database without actors or movies')
+
+    first_release = date(1950, 1, 1)
+    transfer.import_table(
+        'actors',
+        seed_records(
+            scale, 'name,age,gender',
+            lambda i: f'Actor {i},{18 + i % 60},{"fm"[i % 2]}'), 'csv')
+    transfer.import_table(
+        'movies',
+        seed_records(
+            scale, 'title,release_date', lambda i: f'Movie {i},'
+            f'{first_release + timedelta(days=i % 27000)}'), 'csv')
+
+    movies = Movie.__table__
+    for k in range(CAST_SIZE):
+        db.session.execute(cast_members.insert().from_select(
+            ['movie_id', 'actor_id'],
+            select([movies.c.id, (movies.c.id + k) % scale + 1])))
+    bump_version(cast_members.name)
+    db.session.commit()
+
+
+def clean():
+    from models import db, bump_version, cast_members, Actor, Movie
+
+    for table in (cast_members, Actor.__table__, Movie.__table__):
+        deleted = db.session.execute(table.delete()).rowcount
+        bump_version(table.name, row_delta=-deleted)
+    db.session.commit()
+
+
+def rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def child_pids(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as stat:
+                    parent = int(stat.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            if parent == pid:
+                children.append(int(entry))
+    return children
+
+
+class RSSSampler:
+    '''Tracks the peak resident memory of processes in the background.
+
+    get_pids is called again every second, so restarted gunicorn
+    workers are picked up. Reads /proc, the peak is None elsewhere.
+    '''
+    def __init__(self, get_pids):
+        self.get_pids = get_pids
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        pids = []
+        refreshed = 0
+        while not self._stop.is_set():
+            if time.monotonic() - refreshed > 1:
+                pids = self.get_pids()
+                refreshed = time.monotonic()
+            self.peak = max(self.peak, sum(rss_bytes(pid) for pid in pids))
+            self._stop.wait(RSS_SAMPLE_INTERVAL)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    @property
+    def peak_mb(self):
+        if not os.path.isdir('/proc'):
+            return None
+        return round(self.peak / 2**20, 1)
+
+
+def summarize(endpoint, mode, latencies, errors, elapsed, sampler):
+    name, method, path, _ = endpoint
+    latencies = sorted(latencies)
+    result = {
+        'mode': mode,
+        'endpoint': name,
+        'method': method,
+        'path': path,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1),
+        'peak_rss_mb': sampler.peak_mb
+    }
+    for key, fraction in (('p50_ms', 0.50), ('p95_ms', 0.95), ('p99_ms',
+                                                                0.99)):
+        result[key] = (round(percentile(latencies, fraction) * 1000, 2)
+                       if latencies else None)
+    return result
+
+
+def run_test_client(app, endpoints, scale, token, duration):
+    '''Sends each endpoint's requests one at a time in this process.'''
+    test_client = app.test_client()
+    results = []
+    for endpoint in endpoints:
+        latencies = []
+        errors = 0
+        number = 0
+        with RSSSampler(lambda: [os.getpid()]) as sampler:
+            start = time.perf_counter()
+            deadline = start + duration
+            while time.perf_counter() < deadline:
+                method, path, body, headers = endpoint_request(
+                    endpoint, scale, token, 0, 1, number)
+                number += 1
+                sent = time.perf_counter()
+                response = test_client.open(path,
+                                            method=method,
+                                            data=body,
+                                            headers=headers)
+                response.get_data()
+                if response.status_code >= 400:
+                    errors += 1
+                else:
+                    latencies.append(time.perf_counter() - sent)
+            elapsed = time.perf_counter() - start
+        results.append(
+            summarize(endpoint, 'test_client', latencies, errors, elapsed,
+                      sampler))
+        print_result(results[-1])
+    return results
+
+
+def run_gunicorn(endpoints, scale, token, args, env):
+    '''Loads a gunicorn server with args.clients processes per endpoint.'''
+    server = subprocess.Popen([
+        'gunicorn', '-c', 'gunicorn.conf.py', '-b', f'127.0.0.1:{PORT}',
+        '-w',
+        str(args.workers), '--threads',
+        str(args.threads), 'app:create_app()'
+    ],
+                              cwd=ROOT,
+                              env=env,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        wait_until_up()
+        for endpoint in endpoints:
+            queue = multiprocessing.Queue()
+            with RSSSampler(lambda: child_pids(server.pid)) as sampler:
+                start = time.perf_counter()
+                deadline = start + args.duration
+                processes = [
+                    multiprocessing.Process(
+                        target=client,
+                        args=(functools.partial(endpoint_request, endpoint,
+                                                scale, token, offset,
+                                                args.clients), deadline,
+                              queue)) for offset in range(args.clients)
+                ]
+                for process in processes:
+                    process.start()
+                outcomes = [queue.get() for _ in processes]
+                for process in processes:
+                    process.join()
+                elapsed = time.perf_counter() - start
+
+            results.append(
+                summarize(endpoint, 'gunicorn',
+                          [latency for outcome in outcomes
+                           for latency in outcome[0]],
+                          sum(outcome[1] for outcome in outcomes), elapsed,
+                          sampler))
+            print_result(results[-1])
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    return results
+
+
+def print_result(result):
+    def ms(value):
+        return f'{value:8.1f}' if value is not None else f'{"-":>8}'
+
+    rss = result['peak_rss_mb']
+    print(f'{result["mode"]:12} {result["endpoint"]:18} '
+          f'{result["rps"]:8.0f} {ms(result["p50_ms"])} '
+          f'{ms(result["p95_ms"])} {ms(result["p99_ms"])} '
+          f'{rss if rss is not None else "-":>8} {result["errors"]:6d}')
+
+
+def compare(results, path):
+    '''Prints the change of each endpoint against an earlier run.'''
+    with open(path) as results_file:
+        previous = json.load(results_file)
+    before = {(result['mode'], result['endpoint']): result
+              for result in previous['results']}
+
+    print(f'\nChange against {previous["commit"] or path} '
+          f'(scale {previous["scale"]}):')
+    print(f'{"mode":12} {"endpoint":18} {"req/s":>8} {"p95":>8}')
+    for result in results:
+        old = before.get((result['mode'], result['endpoint']))
+        if old is None or not old['rps'] or not old['p95_ms']:
+            continue
+        rps = (result['rps'] / old['rps'] - 1) * 100
+        p95 = (result['p95_ms'] / old['p95_ms'] - 1) * 100
+        print(f'{result["mode"]:12} {result["endpoint"]:18} '
+              f'{rps:+7.0f}% {p95:+7.0f}%')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              cwd=ROOT,
+                              check=True,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=parse_scale, default=1000)
+    parser.add_argument('--duration',
+                        type=float,
+                        default=3,
+                        help='Seconds each endpoint is run for')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--mode',
+                        choices=('test_client', 'gunicorn', 'both'),
+                        default='both')
+    parser.add_argument('--only',
+                        nargs='+',
+                        metavar='ENDPOINT',
+                        help='Run only these endpoints')
+    parser.add_argument('--database-url')
+    parser.add_argument('--output', default='bench_endpoints.json')
+    parser.add_argument('--compare', metavar='FILE')
+    args = parser.parse_args()
+
+    scratch = None
+    if args.database_url is None:
+        scratch = tempfile.NamedTemporaryFile(suffix='.sqlite')
+        args.database_url = f'sqlite:///{scratch.name}'
+
+    # Verify tokens against a local JWKS document instead of Auth0
+    import auth
+    keys = tempfile.TemporaryDirectory()
+    key_pair = auth.LocalKeyPair()
+    jwks_path = os.path.join(keys.name, 'jwks.json')
+    with open(jwks_path, 'w') as jwks_file:
+        json.dump(key_pair.jwks(), jwks_file)
+
+    env = dict(os.environ,
+               DATABASE_URL=args.database_url,
+               AUTH_KEY_SOURCE='jwks_file',
+               AUTH_JWKS_FILE=jwks_path)
+    os.environ.update(env)
+
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    token = auth.mint_token('producer', signer=key_pair)
+
+    routes = {rule.endpoint for rule in app.url_map.iter_rules()} - {'static'}
+    missing = routes - {endpoint[0] for endpoint in ENDPOINTS}
+    if missing:
+        raise SystemExit('No benchmark request for '
+                         f'{", ".join(sorted(missing))}, add it to ENDPOINTS')
+    endpoints = [
+        endpoint for endpoint in ENDPOINTS
+        if not args.only or endpoint[0] in args.only
+    ]
+
+    modes = ['test_client', 'gunicorn'] if args.mode == 'both' else [
+        args.mode
+    ]
+    print(f'{app.config["SQLALCHEMY_DATABASE_URI"].split(":")[0]}, scale '
+          f'{args.scale}, {args.duration:g}s per endpoint, gunicorn '
+          f'{args.workers} workers x {args.threads} threads, '
+          f'{args.clients} clients')
+    print(f'{"mode":12} {"endpoint":18} {"req/s":>8} {"p50 ms":>8} '
+          f'{"p95 ms":>8} {"p99 ms":>8} {"rss MB":>8} {"errors":>6}')
+
+    results = []
+    for mode in modes:
+        # Writes and deletes of the previous mode change the data
+        with app.app_context():
+            if scratch is not None:
+                db.create_all()
+            seed(args.scale)
+            db.session.remove()
+            db.engine.dispose()
+        try:
+            if mode == 'test_client':
+                results += run_test_client(app, endpoints, args.scale, token,
+                                           args.duration)
+            else:
+                results += run_gunicorn(endpoints, args.scale, token, args,
+                                        env)
+        finally:
+            with app.app_context():
+                clean()
+                db.session.remove()
+
+    with open(args.output, 'w') as output:
+        json.dump(
+            {
+                'commit': git_commit(),
+                'date': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':')
+                [0],
+                'scale': args.scale,
+                'duration': args.duration,
+                'clients': args.clients,
+                'workers': args.workers,
+                'threads': args.threads,
+                'results': results
+            },
+            output,
+            indent=2)
+    print(f'Wrote {args.output}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
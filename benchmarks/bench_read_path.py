@@ -0,0 +1,102 @@
+'''Compares the ORM and Core read paths in rows per second.
+
+Seeds a database with movies and times formatting them into dicts
+through ORM instances and format(), as the list endpoints used to,
+against Core result rows and format_row(), as they do now.
+
+Usage:
+    python benchmarks/bench_read_path.py [--rows N] [--repeat N]
+        [--database-url URL]
+
+Without --database-url a throwaway SQLite file is used. Another
+database must have been migrated; the rows seeded into it are deleted
+again afterwards.
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0,
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def orm_read(Movie, limit):
+    return [movie.format() for movie in Movie.query.order_by(
+        Movie.id).limit(limit)]
+
+
+def core_read(db, Movie, limit):
+    table = Movie.__table__
+    result = db.session.execute(
+        table.select().order_by(table.c.id).limit(limit))
+    return [Movie.format_row(row) for row in result]
+
+
+def best_time(read, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        read()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    scratch = None
+    if args.database_url is None:
+        scratch = tempfile.NamedTemporaryFile(suffix='.sqlite')
+        args.database_url = f'sqlite:///{scratch.name}'
+    os.environ['DATABASE_URL'] = args.database_url
+    # Only public reads are measured, no token is ever verified
+    os.environ.setdefault('AUTH_KEY_SOURCE', 'local')
+
+    from app import create_app
+    from models import db, Movie
+
+    app = create_app()
+    with app.app_context():
+        if scratch is not None:
+            # A throwaway database has no migrations to run
+            db.create_all()
+        start = datetime(2000, 1, 1)
+        ids = Movie.bulk_insert([{
+            'title': f'Benchmark {i}',
+            'release_date': start + timedelta(days=i % 7300)
+        } for i in range(args.rows)])
+
+        try:
+            assert orm_read(Movie, 100) == core_read(db, Movie, 100)
+            db.session.remove()
+
+            # The ORM path pays for a fresh identity map on every request
+            def orm():
+                orm_read(Movie, args.rows)
+                db.session.remove()
+
+            def core():
+                core_read(db, Movie, args.rows)
+                db.session.remove()
+
+            orm_time = best_time(orm, args.repeat)
+            core_time = best_time(core, args.repeat)
+        finally:
+            Movie.bulk_delete(ids)
+
+    print(f'{app.config["SQLALCHEMY_DATABASE_URI"].split(":")[0]}, '
+          f'{args.rows} rows, best of {args.repeat}')
+    print(f'orm:  {args.rows / orm_time:12,.0f} rows/s')
+    print(f'core: {args.rows / core_time:12,.0f} rows/s '
+          f'({orm_time / core_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''Measures the time from a cold start to the first response.
+
+Each run starts a fresh interpreter that imports the app module, builds
+the app and serves one request through the test client, and reports
+the time of each step. The median of the runs is printed.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs N] [--path PATH]
+        [--root DIR] [--database-url URL]
+
+--root measures another checkout of the repository, e.g. a git worktree
+of an older commit, for before and after numbers. Checkouts creating
+the app at import report it under import. The database must have been
+migrated; the default path does not need any rows.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in the child: time each step from a cold interpreter
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import app as module
+imported = time.perf_counter()
+app = getattr(module, 'app', None) or module.create_app()
+created = time.perf_counter()
+response = app.test_client().get(sys.argv[1])
+served = time.perf_counter()
+print(json.dumps({
+    'import': imported - start,
+    'create_app': created - imported,
+    'first_request': served - created,
+    'status': response.status_code
+}))
+'''
+
+STEPS = ('import', 'create_app', 'first_request', 'total')
+
+
+def run_once(root, path, env):
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD, path],
+                            cwd=root,
+                            env=env,
+                            check=True,
+                            stdout=subprocess.PIPE).stdout
+    timings = json.loads(output)
+    timings['total'] = time.perf_counter() - start
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--path', default='/cache/stats')
+    parser.add_argument('--root', default=ROOT)
+    parser.add_argument('--database-url',
+                        default=os.environ.get('DATABASE_URL'))
+    args = parser.parse_args()
+    if args.database_url is None:
+        parser.error('set DATABASE_URL or pass --database-url')
+
+    env = dict(os.environ, DATABASE_URL=args.database_url)
+    # The default path needs no token
+    env.setdefault('AUTH_KEY_SOURCE', 'local')
+    env['PYTHONPATH'] = args.root
+    # Warm the OS file cache, so the first run is not the only cold one
+    run_once(args.root, args.path, env)
+    runs = [run_once(args.root, args.path, env) for _ in range(args.runs)]
+
+    print(f'{os.path.abspath(args.root)}, GET {args.path} '
+          f'({runs[0]["status"]}), median of {args.runs} runs')
+    for step in STEPS:
+        median = statistics.median(run[step] for run in runs)
+        print(f'{step:14} {median * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+'''Load tests the API under gunicorn with different worker models.
+
+Starts gunicorn with gunicorn.conf.py once per worker setup, drives it
+with concurrent keep-alive clients for a fixed time and reports
+requests per second and latency percentiles for each.
+
+Usage:
+    python benchmarks/bench_workers.py [--clients N] [--duration S]
+        [--path PATH] [--database-url URL]
+
+The database defaults to DATABASE_URL. Movies are seeded before the
+runs and deleted again afterwards.
+'''
+import argparse
+import functools
+import http.client
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PORT = 8765
+SEED_ROWS = 1000
+
+WORKER_MODELS = {
+    'sync 4 workers': ['-k', 'sync', '-w', '4'],
+    'gthread 2 workers x 4 threads':
+    ['-k', 'gthread', '-w', '2', '--threads', '4'],
+    'gthread 4 workers x 4 threads':
+    ['-k', 'gthread', '-w', '4', '--threads', '4']
+}
+
+
+def get_request(path, number):
+    return 'GET', path, None, {}
+
+
+def client(build_request, deadline, results):
+    '''Sends requests one after another until the deadline.
+
+    build_request(n) returns the method, path, body and headers of the
+    n-th request of this client. Responses with a 4xx or 5xx status
+    count as errors, not latencies. Like browsers, a request failing on a
+    reused keep-alive connection, which the server may have closed in
+    the meantime (a worker reaching max_requests for example), is
+    retried once on a new connection.
+    '''
+    latencies = []
+    errors = 0
+    connection = None
+    number = 0
+    while time.perf_counter() < deadline:
+        method, path, body, headers = build_request(number)
+        number += 1
+        start = time.perf_counter()
+        for attempt in range(2):
+            reused = connection is not None
+            if connection is None:
+                connection = http.client.HTTPConnection('127.0.0.1', PORT)
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = None
+                if reused and attempt == 0:
+                    continue
+                errors += 1
+                break
+
+            if response.status >= 400:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+            if response.will_close:
+                connection.close()
+                connection = None
+            break
+    results.put((latencies, errors))
+
+
+def wait_until_up(timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', PORT)
+            connection.request('GET', '/cache/stats')
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn did not start')
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(options, path, clients, duration):
+    server = subprocess.Popen(
+        ['gunicorn', '-c', 'gunicorn.conf.py', '-b', f'127.0.0.1:{PORT}'] +
+        options + ['app:create_app()'],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up()
+        results = multiprocessing.Queue()
+        deadline = time.perf_counter() + duration
+        processes = [
+            multiprocessing.Process(target=client,
+                                    args=(functools.partial(
+                                        get_request, path), deadline, results))
+            for _ in range(clients)
+        ]
+        for process in processes:
+            process.start()
+        outcomes = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    latencies = sorted(latency for outcome in outcomes
+                       for latency in outcome[0])
+    errors = sum(outcome[1] for outcome in outcomes)
+    return {
+        'rps': len(latencies) / duration,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'errors': errors
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--path', default='/movies?limit=20')
+    parser.add_argument('--database-url',
+                        default=os.environ.get('DATABASE_URL'))
+    args = parser.parse_args()
+    if args.database_url is None:
+        parser.error('set DATABASE_URL or pass --database-url')
+    os.environ['DATABASE_URL'] = args.database_url
+    # Only public reads are measured, no token is ever verified
+    os.environ.setdefault('AUTH_KEY_SOURCE', 'local')
+
+    from app import create_app
+    from models import Movie
+
+    app = create_app()
+    with app.app_context():
+        start = datetime(2000, 1, 1)
+        ids = Movie.bulk_insert([{
+            'title': f'Benchmark {i}',
+            'release_date': start + timedelta(days=i)
+        } for i in range(SEED_ROWS)])
+
+    try:
+        print(f'GET {args.path}, {args.clients} clients, '
+              f'{args.duration:.0f}s each')
+        print(f'{"workers":32} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} '
+              f'{"p99 ms":>8} {"errors":>7}')
+        for name, options in WORKER_MODELS.items():
+            result = run(options, args.path, args.clients, args.duration)
+            print(f'{name:32} {result["rps"]:8.0f} {result["p50"]:8.1f} '
+                  f'{result["p95"]:8.1f} {result["p99"]:8.1f} '
+                  f'{result["errors"]:7d}')
+    finally:
+        with app.app_context():
+            Movie.bulk_delete(ids)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, request
+from werkzeug.urls import url_encode
+
+from models import write_listeners
+
+RESPONSE_CACHE_BACKEND = 'null'
+RESPONSE_CACHE_SIZE = 1000
+RESPONSE_CACHE_TTL = 60
+RESPONSE_CACHE_PATH = None
+
+
+class NullCache:
+    '''Backend that stores nothing, used when caching is disabled.'''
+    name = 'null'
+
+    def __init__(self, **kwargs):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def generation(self, namespace):
+        return 0
+
+    def invalidate(self, namespace):
+        pass
+
+    def size(self):
+        return 0
+
+
+class MemoryCache(NullCache):
+    '''In-process LRU backend.
+
+    Fastest option, but each process holds its own copy and only sees
+    invalidations from writes made in that process. Other gunicorn
+    workers keep serving their entries until the TTL runs out.
+    '''
+    name = 'memory'
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+                 **kwargs):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def generation(self, namespace):
+        return self._generations.get(namespace, 0)
+
+    def invalidate(self, namespace):
+        with self._lock:
+            self._generations[namespace] = self.generation(namespace) + 1
+
+    def size(self):
+        return len(self._entries)
+
+
+class SQLiteCache(NullCache):
+    '''Backend shared by every process on the host via a SQLite file.
+
+    Entries and invalidations are visible to all gunicorn workers, so a
+    write in one worker invalidates the cached responses of the others.
+    When full, the oldest entries are evicted first. Hit and miss
+    counters are kept per process.
+
+    Entries are (body, headers) tuples, stored as a BLOB and a JSON
+    object so reading the file never runs code. Without a path the
+    file goes in a directory only the current user can access, under
+    $XDG_CACHE_HOME or ~/.cache.
+    '''
+    name = 'sqlite'
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_size=RESPONSE_CACHE_SIZE,
+                 ttl=RESPONSE_CACHE_TTL, **kwargs):
+        super().__init__()
+        self.path = path or default_cache_path()
+        self.max_size = max_size
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+                               'key TEXT PRIMARY KEY, body BLOB, '
+                               'headers TEXT, stored REAL, expires REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS responses_stored '
+                               'ON responses (stored)')
+            connection.execute('CREATE TABLE IF NOT EXISTS generations ('
+                               'namespace TEXT PRIMARY KEY, '
+                               'generation INTEGER)')
+
+    def _connect(self):
+        # Connections are per thread and must not cross a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path,
+                                         timeout=5,
+                                         isolation_level=None)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT body, headers FROM responses '
+            'WHERE key = ? AND expires > ?', (key, time.time())).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return row[0], json.loads(row[1])
+
+    def set(self, key, value):
+        body, headers = value
+        connection = self._connect()
+        now = time.time()
+        connection.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+            (key, body, json.dumps(headers), now, now + self.ttl))
+
+        excess = self.size() - self.max_size
+        if excess > 0:
+            connection.execute(
+                'DELETE FROM responses WHERE key IN (SELECT key FROM '
+                'responses ORDER BY expires <= ? DESC, stored LIMIT ?)',
+                (now, excess))
+            self.evictions += excess
+
+    def generation(self, namespace):
+        row = self._connect().execute(
+            'SELECT generation FROM generations WHERE namespace = ?',
+            (namespace, )).fetchone()
+        return row[0] if row else 0
+
+    def invalidate(self, namespace):
+        self._connect().execute(
+            'INSERT INTO generations VALUES (?, 1) ON CONFLICT (namespace) '
+            'DO UPDATE SET generation = generation + 1', (namespace, ))
+
+    def size(self):
+        return self._connect().execute(
+            'SELECT count(*) FROM responses').fetchone()[0]
+
+
+def default_cache_path():
+    '''Returns the SQLite cache file in a directory private to the user.
+
+    Raises:
+        RuntimeError if the directory is owned by someone else.
+    '''
+    directory = os.path.join(
+        os.environ.get('XDG_CACHE_HOME')
+        or os.path.join(os.path.expanduser('~'), '.cache'), 'casting-agency')
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if os.stat(directory).st_uid != os.getuid():
+        raise RuntimeError(f'{directory} is not owned by the current user')
+    os.chmod(directory, 0o700)
+    return os.path.join(directory, 'response-cache.sqlite')
+
+
+def read_tables(table_names, includes=None):
+    '''Returns the tables a read route depends on for this request.
+
+    Args:
+        table_names: the tables the route always reads.
+        includes: optional dict of ?include= values to the extra
+            tables they make the route read.
+    '''
+    tables = list(table_names)
+    for name in request.args.get('include', '').split(','):
+        for table_name in (includes or {}).get(name, ()):
+            if table_name not in tables:
+                tables.append(table_name)
+    return tables
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (NullCache, MemoryCache, SQLiteCache)
+}
+
+
+# Response Cache
+'''
+ResponseCache
+Caches the responses of read routes, keyed by path and query string.
+Every key embeds a generation number per table the route reads. Writes
+to a table bump its generation once their transaction commits (see
+models.write_listeners), which orphans every entry built from the old
+data without having to find and delete them.
+'''
+
+
+class ResponseCache:
+    def __init__(self):
+        self.backend = NullCache()
+        write_listeners.append(self.invalidate)
+
+    def init_app(self, app):
+        '''Selects the backend from the RESPONSE_CACHE_* config.
+
+        Raises:
+            ValueError if RESPONSE_CACHE_BACKEND is unknown.
+        '''
+        config = {
+            'RESPONSE_CACHE_BACKEND':
+            os.environ.get('RESPONSE_CACHE_BACKEND', RESPONSE_CACHE_BACKEND),
+            'RESPONSE_CACHE_SIZE':
+            int(os.environ.get('RESPONSE_CACHE_SIZE', RESPONSE_CACHE_SIZE)),
+            'RESPONSE_CACHE_TTL':
+            int(os.environ.get('RESPONSE_CACHE_TTL', RESPONSE_CACHE_TTL)),
+            'RESPONSE_CACHE_PATH':
+            os.environ.get('RESPONSE_CACHE_PATH', RESPONSE_CACHE_PATH)
+        }
+        for key, value in config.items():
+            app.config.setdefault(key, value)
+
+        backend = app.config['RESPONSE_CACHE_BACKEND']
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown response cache backend {backend}')
+
+        self.backend = BACKENDS[backend](
+            max_size=app.config['RESPONSE_CACHE_SIZE'],
+            ttl=app.config['RESPONSE_CACHE_TTL'],
+            path=app.config['RESPONSE_CACHE_PATH'])
+        app.extensions['response_cache'] = self
+
+    def invalidate(self, *table_names):
+        for table_name in table_names:
+            self.backend.invalidate(table_name)
+
+    def key(self, table_names):
+        generations = ','.join(
+            str(self.backend.generation(table_name))
+            for table_name in table_names)
+        # Re-encoded, so a value containing & or = cannot pass for
+        # several arguments
+        query = url_encode(sorted(request.args.items(multi=True)))
+        return f'{generations}:{request.path}?{query}'
+
+    def cached(self, *table_names, includes=None):
+        '''Decorator caching the 200 responses of a read route.
+
+        A cached response is served with X-Cache: HIT, or as a 304 if
+        it matches the request's If-None-Match. includes maps ?include=
+        values to the extra tables they make the route read.
+        '''
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                key = self.key(read_tables(table_names, includes))
+                cached = self.backend.get(key)
+
+                if cached is not None:
+                    body, headers = cached
+                    etag = headers.get('ETag', '').strip('"')
+                    if etag and request.if_none_match.contains_weak(etag):
+                        response = Response(status=304)
+                        response.set_etag(etag)
+                    else:
+                        response = Response(body, headers=headers)
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                response = f(*args, **kwargs)
+                if response.status_code == 200 and not response.is_streamed:
+                    headers = {
+                        name: value
+                        for name, value in response.headers.items()
+                        if name in ('Content-Type', 'ETag')
+                    }
+                    self.backend.set(key, (response.get_data(), headers))
+                response.headers['X-Cache'] = 'MISS'
+                return response
+
+            return wrapper
+
+        return cached_decorator
+
+    def stats(self):
+        backend = self.backend
+        lookups = backend.hits + backend.misses
+        return {
+            'backend': backend.name,
+            'size': backend.size(),
+            'hits': backend.hits,
+            'misses': backend.misses,
+            'hit_ratio': backend.hits / lookups if lookups else 0.0,
+            'evictions': backend.evictions
+        }
+
+
+response_cache = ResponseCache()
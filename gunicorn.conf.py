@@ -0,0 +1,75 @@
+import glob
+import multiprocessing
+import os
+import sys
+import tempfile
+
+# Every setting can be overridden with the environment variable next to
+# it, or on the gunicorn command line.
+bind = os.environ.get('GUNICORN_BIND',
+                      f'0.0.0.0:{os.environ.get("PORT", "8000")}')
+
+# gthread workers serve several requests at once per process while one
+# waits on the database. Keep threads at or below DB_POOL_SIZE +
+# DB_MAX_OVERFLOW so a thread never waits for a connection.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(
+    os.environ.get('WEB_CONCURRENCY',
+                   max(2, multiprocessing.cpu_count())))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Import the app once in the master, so workers share its memory pages
+# copy-on-write and a broken app fails before any worker starts
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+# Longer than the idle timeout of the load balancer in front would make
+# it reuse connections we are about to close
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# Bulk deletes list their IDs in the URL, so allow request lines up to
+# gunicorn's maximum rather than its default of 4094 bytes
+limit_request_line = int(os.environ.get('GUNICORN_LIMIT_REQUEST_LINE', 8190))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+# Worker heartbeats on a tmpfs, so a slow disk cannot get workers killed
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# Prometheus metrics: every worker writes its samples to files in this
+# directory so /metrics can sum them up. It must be set before the app,
+# and with it prometheus_client, is imported.
+multiproc_dir = os.environ.setdefault(
+    'prometheus_multiproc_dir',
+    os.path.join(tempfile.gettempdir(), 'casting-metrics'))
+os.makedirs(multiproc_dir, exist_ok=True)
+# Samples of a previous run would be added to the new ones
+for path in glob.glob(os.path.join(multiproc_dir, '*.db')):
+    os.remove(path)
+
+
+def dispose_engine():
+    '''Drops the pooled database connections of this process.
+
+    A connection shared by two processes after a fork gets their
+    queries and results mixed up. Only does anything once the app has
+    been imported, so the master does not import it without preload.
+    '''
+    models = sys.modules.get('models')
+    if models is not None and models.db.app is not None:
+        models.db.get_engine(models.db.app).dispose()
+
+
+def when_ready(server):
+    # Close whatever the master opened while preloading the app
+    dispose_engine()
+
+
+def post_fork(server, worker):
+    dispose_engine()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
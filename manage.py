@@ -1,13 +1,147 @@
+import json
+import os
+import sys
+import time
+
+from flask import current_app
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app
+import auth
+import transfer
+from app import create_app
 from models import db
 
-migrate = Migrate(app, db)
-manager = Manager(app)
+migrate = Migrate()
+
+
+def create_manage_app():
+    '''Builds the app the commands run in, once a command is chosen.'''
+    app = create_app()
+    migrate.init_app(app, db)
+    return app
+
+
+manager = Manager(create_manage_app)
 
 manager.add_command('db', MigrateCommand)
 
+
+@manager.option('-o',
+                '--output',
+                dest='output',
+                default='keys',
+                help='Directory to write private.pem and jwks.json to')
+def generate_keys(output):
+    '''Writes a local RSA key pair for offline auth.
+
+    Serve with AUTH_KEY_SOURCE=local and AUTH_PRIVATE_KEY set to the
+    private key, or AUTH_KEY_SOURCE=jwks_file and AUTH_JWKS_FILE set
+    to the JWKS document to verify tokens with the public key only.
+    '''
+    os.makedirs(output, exist_ok=True)
+    key_pair = auth.LocalKeyPair()
+
+    with open(os.path.join(output, 'private.pem'), 'w') as key_file:
+        key_file.write(key_pair.private_key_pem)
+    with open(os.path.join(output, 'jwks.json'), 'w') as jwks_file:
+        json.dump(key_pair.jwks(), jwks_file)
+
+    print(f'Wrote {output}/private.pem and {output}/jwks.json')
+
+
+@manager.option('-r',
+                '--role',
+                dest='role',
+                required=True,
+                choices=sorted(auth.ROLE_PERMISSIONS))
+@manager.option('-k',
+                '--private-key',
+                dest='private_key',
+                help='PEM private key written by generate_keys, defaults '
+                'to AUTH_PRIVATE_KEY')
+@manager.option('-e',
+                '--expires-in',
+                dest='expires_in',
+                type=int,
+                default=86400,
+                help='Seconds until the token expires')
+def mint_token(role, private_key, expires_in):
+    '''Prints a token for a role signed with a local private key.'''
+    private_key = private_key or current_app.config['AUTH_PRIVATE_KEY']
+    if not private_key:
+        raise SystemExit('A private key is required, see generate_keys.')
+
+    signer = auth.LocalKeyPair.from_file(private_key)
+    print(auth.mint_token(role, signer=signer, expires_in=expires_in))
+
+
+def transfer_format(path, fmt):
+    if fmt:
+        return fmt
+    if path.endswith('.csv'):
+        return 'csv'
+    if path.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    raise SystemExit('Cannot tell the format from the file name, use -f.')
+
+
+def report(action, count, started):
+    elapsed = time.perf_counter() - started
+    rate = count / elapsed if elapsed else 0
+    print(f'{action} {count} rows in {elapsed:.2f}s ({rate:.0f} rows/s)',
+          file=sys.stderr)
+
+
+@manager.option('-t',
+                '--table',
+                dest='table',
+                required=True,
+                choices=sorted(transfer.TABLES))
+@manager.option('-i',
+                '--input',
+                dest='path',
+                required=True,
+                help='CSV or NDJSON file to load, - for stdin')
+@manager.option('-f', '--format', dest='fmt', choices=transfer.FORMATS)
+def import_table(table, path, fmt):
+    '''Loads a CSV or NDJSON file into a table.'''
+    fmt = transfer_format(path, fmt) if path != '-' else fmt or 'ndjson'
+    started = time.perf_counter()
+
+    if path == '-':
+        count = transfer.import_table(table, sys.stdin, fmt)
+    else:
+        with open(path, newline='') as in_file:
+            count = transfer.import_table(table, in_file, fmt)
+
+    report('Imported', count, started)
+
+
+@manager.option('-t',
+                '--table',
+                dest='table',
+                required=True,
+                choices=sorted(transfer.TABLES))
+@manager.option('-o',
+                '--output',
+                dest='path',
+                required=True,
+                help='CSV or NDJSON file to write, - for stdout')
+@manager.option('-f', '--format', dest='fmt', choices=transfer.FORMATS)
+def export_table(table, path, fmt):
+    '''Writes every row of a table to a CSV or NDJSON file.'''
+    fmt = transfer_format(path, fmt) if path != '-' else fmt or 'ndjson'
+    started = time.perf_counter()
+
+    if path == '-':
+        count = transfer.export_table(table, sys.stdout, fmt)
+    else:
+        with open(path, 'w', newline='') as out_file:
+            count = transfer.export_table(table, out_file, fmt)
+
+    report('Exported', count, started)
+
+
 if __name__ == '__main__':
     manager.run()
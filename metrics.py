@@ -0,0 +1,128 @@
+import os
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry,
+                               Counter, Histogram, REGISTRY, generate_latest)
+from prometheus_client.multiprocess import MultiProcessCollector
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Set by gunicorn.conf.py (or by hand) before the workers start, so
+# every worker writes its samples to files in this directory
+MULTIPROC_DIR_ENV = 'prometheus_multiproc_dir'
+
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+REQUEST_COUNT = Counter('http_requests_total', 'HTTP requests handled.',
+                        ['method', 'endpoint', 'status'])
+REQUEST_LATENCY = Histogram('http_request_duration_seconds',
+                            'Time spent handling HTTP requests.',
+                            ['method', 'endpoint', 'status'])
+DB_QUERIES = Counter('db_queries_total', 'SQL statements executed.',
+                     ['endpoint'])
+DB_QUERIES_PER_REQUEST = Histogram('db_queries_per_request',
+                                   'SQL statements executed per request.',
+                                   ['endpoint'],
+                                   buckets=QUERY_COUNT_BUCKETS)
+DB_TIME_PER_REQUEST = Histogram('db_time_per_request_seconds',
+                                'Time spent in SQL statements per request.',
+                                ['endpoint'])
+AUTH_VERIFY_LATENCY = Histogram('auth_verify_duration_seconds',
+                                'Time spent verifying access tokens.',
+                                ['outcome'])
+
+
+@contextmanager
+def time_auth_verify():
+    '''Times a token verification into AUTH_VERIFY_LATENCY.'''
+    start = time.perf_counter()
+    outcome = 'invalid'
+    try:
+        yield
+        outcome = 'valid'
+    finally:
+        AUTH_VERIFY_LATENCY.labels(outcome).observe(time.perf_counter() -
+                                                    start)
+
+
+def collect():
+    '''Returns the metrics in Prometheus text format.
+
+    With several gunicorn workers each one writes its samples to the
+    prometheus_multiproc_dir directory, and the worker answering the
+    scrape sums them all up, so counts do not depend on which worker
+    Prometheus happens to reach.
+    '''
+    if MULTIPROC_DIR_ENV in os.environ:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+# Request Metrics
+'''
+RequestMetrics
+Records the latency and status of every request, labelled by Flask
+endpoint rather than URL so IDs do not create a series each. Statements
+run through the engine while a request is handled are counted and timed
+with before/after_cursor_execute and reported per endpoint as well.
+'''
+
+
+class RequestMetrics:
+    def init_app(self, app):
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.add_url_rule('/metrics', 'metrics', self.serve)
+
+        # Listening on the Engine class covers engines Flask-SQLAlchemy
+        # creates later, e.g. when the database URI changes
+        if not event.contains(Engine, 'before_cursor_execute',
+                              self.before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         self.after_cursor_execute)
+        app.extensions['request_metrics'] = self
+
+    def start_request(self):
+        g.metrics_start = time.perf_counter()
+        g.db_queries = 0
+        g.db_time = 0.0
+
+    def finish_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+
+        endpoint = request.endpoint or 'unmatched'
+        labels = (request.method, endpoint, response.status_code)
+        REQUEST_COUNT.labels(*labels).inc()
+        REQUEST_LATENCY.labels(*labels).observe(time.perf_counter() - start)
+        DB_QUERIES.labels(endpoint).inc(g.db_queries)
+        DB_QUERIES_PER_REQUEST.labels(endpoint).observe(g.db_queries)
+        DB_TIME_PER_REQUEST.labels(endpoint).observe(g.db_time)
+        return response
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        if context is not None:
+            context.metrics_start = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        start = getattr(context, 'metrics_start', None)
+        if start is not None and has_request_context() and 'db_queries' in g:
+            g.db_queries += 1
+            g.db_time += time.perf_counter() - start
+
+    def serve(self):
+        '''Handles GET requests for the metrics in Prometheus format.'''
+        return Response(collect(), content_type=CONTENT_TYPE_LATEST)
+
+
+request_metrics = RequestMetrics()
@@ -0,0 +1,32 @@
+"""add table versions
+
+Revision ID: 8a4d0c6e2f11
+Revises: 5f1c2a9d7b3e
+Create Date: 2026-10-17 09:30:12.514206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4d0c6e2f11'
+down_revision = '5f1c2a9d7b3e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table('table_versions',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    op.bulk_insert(table_versions, [
+        {'table_name': 'actors', 'version': 1},
+        {'table_name': 'movies', 'version': 1}
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
@@ -0,0 +1,37 @@
+"""add table row counts
+
+Revision ID: b2d6e8f03a15
+Revises: f4b8a2c61d07
+Create Date: 2026-10-17 18:42:36.120874
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2d6e8f03a15'
+down_revision = 'f4b8a2c61d07'
+branch_labels = None
+depends_on = None
+
+COUNTED_TABLES = ('actors', 'movies')
+
+
+def upgrade():
+    op.add_column('table_versions',
+                  sa.Column('row_count', sa.Integer(), nullable=True))
+
+    postgres = op.get_bind().dialect.name == 'postgresql'
+    for table_name in COUNTED_TABLES:
+        # Block writes until the count is committed, so none of them
+        # is missed or counted twice
+        if postgres:
+            op.execute(f'LOCK TABLE {table_name} IN SHARE MODE')
+        op.execute(f'UPDATE table_versions SET row_count = '
+                   f'(SELECT count(*) FROM {table_name}) '
+                   f"WHERE table_name = '{table_name}'")
+
+
+def downgrade():
+    op.drop_column('table_versions', 'row_count')
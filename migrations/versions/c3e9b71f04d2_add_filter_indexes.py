@@ -0,0 +1,32 @@
+"""add filter indexes
+
+Revision ID: c3e9b71f04d2
+Revises: 8a4d0c6e2f11
+Create Date: 2026-10-17 11:02:47.331862
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e9b71f04d2'
+down_revision = '8a4d0c6e2f11'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_actors_age'), 'actors', ['age'], unique=False)
+    op.create_index(op.f('ix_actors_gender'), 'actors', ['gender'], unique=False)
+    op.create_index(op.f('ix_actors_name'), 'actors', ['name'], unique=False)
+    op.create_index(op.f('ix_movies_release_date'), 'movies', ['release_date'], unique=False)
+    op.create_index(op.f('ix_movies_title'), 'movies', ['title'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_movies_title'), table_name='movies')
+    op.drop_index(op.f('ix_movies_release_date'), table_name='movies')
+    op.drop_index(op.f('ix_actors_name'), table_name='actors')
+    op.drop_index(op.f('ix_actors_gender'), table_name='actors')
+    op.drop_index(op.f('ix_actors_age'), table_name='actors')
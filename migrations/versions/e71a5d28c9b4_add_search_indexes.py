@@ -0,0 +1,53 @@
+"""add search indexes
+
+Revision ID: e71a5d28c9b4
+Revises: c3e9b71f04d2
+Create Date: 2026-10-17 12:18:05.907411
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e71a5d28c9b4'
+down_revision = 'c3e9b71f04d2'
+branch_labels = None
+depends_on = None
+
+SEARCH_COLUMNS = {'movies': 'title', 'actors': 'name'}
+
+
+def pg_trgm_available(bind):
+    return bind.execute(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    ).scalar() is not None
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+
+    trigram = pg_trgm_available(bind)
+    if trigram:
+        # In public, not the first schema on the search_path, so every
+        # schema sharing the database finds its operators
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public')
+
+    for table_name, column_name in SEARCH_COLUMNS.items():
+        op.execute(f'CREATE INDEX ix_{table_name}_{column_name}_fts '
+                   f'ON {table_name} '
+                   f"USING gin (to_tsvector('simple', {column_name}))")
+        if trigram:
+            op.execute(f'CREATE INDEX ix_{table_name}_{column_name}_trgm '
+                       f'ON {table_name} USING gin ({column_name} gin_trgm_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for table_name, column_name in SEARCH_COLUMNS.items():
+        op.execute(f'DROP INDEX IF EXISTS ix_{table_name}_{column_name}_trgm')
+        op.execute(f'DROP INDEX IF EXISTS ix_{table_name}_{column_name}_fts')
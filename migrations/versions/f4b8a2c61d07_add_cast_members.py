@@ -0,0 +1,32 @@
+"""add cast members
+
+Revision ID: f4b8a2c61d07
+Revises: e71a5d28c9b4
+Create Date: 2026-10-17 15:21:09.418230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4b8a2c61d07'
+down_revision = 'e71a5d28c9b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cast_members',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index(op.f('ix_cast_members_actor_id'), 'cast_members', ['actor_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_cast_members_actor_id'), table_name='cast_members')
+    op.drop_table('cast_members')
@@ -1,28 +1,469 @@
-from sqlalchemy import Column, String, Integer, DateTime, create_engine
+from sqlalchemy import (Column, String, Integer, DateTime, DDL, ForeignKey,
+                        and_, bindparam, case, create_engine, event, func,
+                        literal, or_, select, text)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
 from flask_sqlalchemy import SQLAlchemy
 import json
-import os
+import re
+import sqlite3
 
-database_path = os.environ['DATABASE_URL']
+from pool import engine_options, pool_config
+
+# Maximum number of rows sent in one multi-row INSERT or UPDATE
+BULK_INSERT_BATCH_SIZE = 500
 
 db = SQLAlchemy()
 
+# Callables notified with the names of the tables changed by each commit
+write_listeners = []
+
+
+def setup_db(app, database_path=None):
+    '''Binds the database to the app.
+
+    The database URL defaults to the DATABASE_URL config value. Binding
+    does not connect or create any table: the schema is created and
+    upgraded by the migrations, with `python manage.py db upgrade`.
+
+    The connection pool is configured from the DB_POOL_SIZE,
+    DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE and
+    DB_POOL_PRE_PING config values, and DB_STATEMENT_TIMEOUT sets
+    PostgreSQL's statement_timeout, in milliseconds, for every new
+    connection. Each defaults to the environment variable of the same
+    name.
+    '''
+    database_path = database_path or app.config.get('DATABASE_URL')
+    if not database_path:
+        raise RuntimeError('DATABASE_URL is not set')
+    for key, value in pool_config().items():
+        app.config.setdefault(key, value)
+    backend = make_url(database_path).get_backend_name()
 
-def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        app.config, backend)
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    '''Makes SQLite enforce foreign keys, which it does not by default.
+
+    Without it ON DELETE CASCADE does nothing and the cast of a deleted
+    movie or actor would be handed to a new one reusing its ID.
+    '''
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+class TableVersion(db.Model):
+    '''Version counter for a table, bumped by every write to it.
+
+    row_count is the number of rows in the table, kept up to date by
+    the writes that bump the version. It is NULL for tables that are
+    not counted, such as cast_members whose rows are also removed by
+    ON DELETE CASCADE, and until a migration has counted the table.
+    '''
+    __tablename__ = 'table_versions'
+
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    row_count = Column(Integer)
+
+
+def bump_version(*table_names, row_delta=0):
+    '''Increments table versions within the current transaction.
+
+    The caller commits, so the new version becomes visible together
+    with the change it stands for. The write listeners are notified
+    once the commit succeeds.
+
+    Args:
+        table_names: the tables that were written.
+        row_delta: the number of rows the write added, negative for
+            deletes, added to the row_count of the tables in the same
+            UPDATE.
+    '''
+    versions = TableVersion.__table__
+    values = {'version': versions.c.version + 1}
+    if row_delta:
+        values['row_count'] = versions.c.row_count + row_delta
+    for table_name in table_names:
+        result = db.session.execute(versions.update().where(
+            versions.c.table_name == table_name).values(values))
+        if result.rowcount == 0:
+            insert = versions.insert()
+            if db.engine.dialect.name == 'postgresql':
+                # Two first writes to a table can both get here, the
+                # second one then updates the row the first inserted
+                insert = postgresql.insert(versions).on_conflict_do_update(
+                    index_elements=[versions.c.table_name], set_=values)
+            db.session.execute(
+                insert.values(table_name=table_name, version=1))
+
+    db.session.info.setdefault('changed_tables', set()).update(table_names)
+
+
+def notify_write(*table_names):
+    '''Tells the write listeners that the tables were changed.'''
+    for listener in write_listeners:
+        listener(*table_names)
+
+
+@event.listens_for(db.session, 'after_commit')
+def notify_committed_writes(session):
+    notify_write(*session.info.pop('changed_tables', ()))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_rolled_back_writes(session):
+    session.info.pop('changed_tables', None)
+
+
+def get_versions(*table_names):
+    '''Returns the current version of each table, 0 if never written.'''
+    versions = TableVersion.__table__
+    rows = db.session.execute(
+        select([versions.c.table_name, versions.c.version
+                ]).where(versions.c.table_name.in_(table_names)))
+    current = dict(rows.fetchall())
+    return {name: current.get(name, 0) for name in table_names}
+
+
+def row_count(table_name):
+    '''Returns a scalar select of the maintained row count of a table.
+
+    It selects NULL if the table is not counted.
+    '''
+    versions = TableVersion.__table__
+    return select([versions.c.row_count
+                   ]).where(versions.c.table_name == table_name).as_scalar()
+
+
+def estimate_table_rows(table_name):
+    '''Estimates the rows of a table from pg_class.reltuples.
+
+    The estimate is as of the last VACUUM or ANALYZE of the table and
+    is read without touching the table itself.
+
+    Returns:
+        The estimated number of rows, or None if the database is not
+        PostgreSQL or the table has never been analyzed.
+    '''
+    if db.engine.dialect.name != 'postgresql':
+        return None
+
+    estimate = db.session.execute(
+        'SELECT reltuples FROM pg_class WHERE oid = to_regclass(:name)',
+        {
+            'name': table_name
+        }).scalar()
+    # reltuples is -1 until the table is first analyzed
+    if estimate is None or estimate < 0:
+        return None
+    return int(estimate)
+
+
+def estimate_rows(selection):
+    '''Estimates the rows of a select from the row estimate of its plan.
+
+    Only EXPLAIN is run, so the select itself never reads a row.
+
+    Returns:
+        The estimated number of rows, or None if the database is not
+        PostgreSQL.
+    '''
+    if db.engine.dialect.name != 'postgresql':
+        return None
+
+    compiled = selection.compile(dialect=db.engine.dialect)
+    plan = db.session.connection().execute(f'EXPLAIN (FORMAT JSON) {compiled}',
+                                           compiled.params).scalar()
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def supports_returning():
+    '''Whether the database can return rows from INSERT/UPDATE/DELETE.'''
+    return db.engine.dialect.name == 'postgresql'
+
+
+class BulkOpsMixin:
+    '''Set-based operations shared by the models.'''
+    @classmethod
+    def bulk_insert(cls, rows, batch_size=BULK_INSERT_BATCH_SIZE):
+        '''Inserts many rows in a single transaction.
+
+        On PostgreSQL rows are sent as multi-row INSERT ... RETURNING id
+        statements of batch_size rows each. Other databases insert one
+        row per statement, still within the one transaction.
+
+        Args:
+            rows: list of dicts mapping column names to values.
+            batch_size: number of rows per INSERT statement.
+
+        Returns:
+            The IDs of the new rows, in the same order as rows.
+        '''
+        table = cls.__table__
+        ids = []
+
+        try:
+            if supports_returning():
+                for start in range(0, len(rows), batch_size):
+                    statement = table.insert().values(
+                        rows[start:start + batch_size]).returning(table.c.id)
+                    ids.extend(row.id
+                               for row in db.session.execute(statement))
+            else:
+                for row in rows:
+                    result = db.session.execute(table.insert(), row)
+                    ids.append(result.inserted_primary_key[0])
+            bump_version(table.name, row_delta=len(ids))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        return ids
+
+    @classmethod
+    def update_returning(cls, id, values):
+        '''Updates one row with a single UPDATE statement.
+
+        On PostgreSQL the updated row comes back from UPDATE ...
+        RETURNING. Other databases read it back within the same
+        transaction, only if a row was updated.
+
+        Returns:
+            The updated row formatted like format(), or None if there
+            is no row with that ID.
+        '''
+        table = cls.__table__
+        statement = table.update().where(table.c.id == id).values(**values)
+
+        try:
+            if supports_returning():
+                row = db.session.execute(
+                    statement.returning(*table.c)).fetchone()
+            else:
+                row = None
+                if db.session.execute(statement).rowcount:
+                    row = db.session.execute(
+                        table.select().where(table.c.id == id)).fetchone()
+
+            if row is not None:
+                bump_version(table.name)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        return cls.format_row(row) if row is not None else None
+
+    @classmethod
+    def delete_returning(cls, id):
+        '''Deletes one row with a single DELETE statement.
+
+        Returns:
+            True if the row was deleted, False if there is no row with
+            that ID.
+        '''
+        table = cls.__table__
+        statement = table.delete().where(table.c.id == id)
+
+        try:
+            if supports_returning():
+                deleted = db.session.execute(
+                    statement.returning(table.c.id)).fetchone() is not None
+            else:
+                deleted = db.session.execute(statement).rowcount > 0
+
+            if deleted:
+                bump_version(table.name, row_delta=-1)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        return deleted
+
+    @classmethod
+    def bulk_update(cls, updates, batch_size=BULK_INSERT_BATCH_SIZE):
+        '''Updates many rows, each with its own values, in one transaction.
+
+        On PostgreSQL rows setting the same columns are updated
+        batch_size at a time by UPDATE ... FROM (VALUES ...) RETURNING
+        statements. Other databases look up which rows exist, update
+        them with one executemany per set of columns and read them back.
+
+        Args:
+            updates: list of dicts mapping column names to values, each
+                with the id of the row to update.
+            batch_size: number of rows per UPDATE statement.
+
+        Returns:
+            The updated rows formatted like format(), ordered by ID.
+            IDs without a row are left out.
+        '''
+        table = cls.__table__
+        groups = {}
+        for values in updates:
+            columns = tuple(name for name in table.c.keys()
+                            if name in values and name != 'id')
+            groups.setdefault(columns, []).append(values)
+
+        try:
+            if supports_returning():
+                rows = []
+                for columns, group in groups.items():
+                    for start in range(0, len(group), batch_size):
+                        rows.extend(
+                            db.session.execute(*cls._update_from_values(
+                                columns, group[start:start + batch_size])))
+            else:
+                ids = [values['id'] for values in updates]
+                existing = {
+                    row.id
+                    for row in db.session.execute(
+                        select([table.c.id]).where(table.c.id.in_(ids)))
+                }
+                for columns, group in groups.items():
+                    group = [{**values, '_id': values['id']}
+                             for values in group if values['id'] in existing]
+                    if group:
+                        db.session.execute(
+                            table.update().where(
+                                table.c.id == bindparam('_id')).values(
+                                    {name: bindparam(name)
+                                     for name in columns}), group)
+                rows = []
+                if existing:
+                    rows = db.session.execute(table.select().where(
+                        table.c.id.in_(sorted(existing)))).fetchall()
+
+            if rows:
+                bump_version(table.name)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        rows.sort(key=lambda row: row.id)
+        return [cls.format_row(row) for row in rows]
+
+    @classmethod
+    def _update_from_values(cls, columns, updates):
+        '''Builds an UPDATE ... FROM (VALUES ...) RETURNING statement.
+
+        Every value is cast to the type of its column, as PostgreSQL
+        would otherwise type a VALUES column of strings or NULLs as
+        text.
+
+        Returns:
+            The statement and its parameters.
+        '''
+        table = cls.__table__
+        dialect = db.engine.dialect
+        names = ('id', ) + columns
+        types = {
+            name: table.c[name].type.compile(dialect=dialect)
+            for name in names
+        }
+        params = {}
+        values = []
+        for index, update in enumerate(updates):
+            casts = []
+            for name in names:
+                params[f'{name}_{index}'] = update[name]
+                casts.append(f'CAST(:{name}_{index} AS {types[name]})')
+            values.append(f'({", ".join(casts)})')
+
+        assignments = ', '.join(f'{name} = v.{name}' for name in columns)
+        returning = ', '.join(f'{table.name}.{name}'
+                              for name in table.c.keys())
+        statement = text(
+            f'UPDATE {table.name} SET {assignments} '
+            f'FROM (VALUES {", ".join(values)}) AS v ({", ".join(names)}) '
+            f'WHERE {table.name}.id = v.id RETURNING {returning}')
+        return statement, params
+
+    @classmethod
+    def bulk_delete(cls, ids):
+        '''Deletes many rows with a single DELETE ... WHERE id IN statement.
+
+        On PostgreSQL the deleted IDs come back from DELETE ...
+        RETURNING. Other databases look them up first, within the same
+        transaction.
+
+        Returns:
+            The IDs of the deleted rows. IDs without a row are left out.
+        '''
+        table = cls.__table__
+        statement = table.delete().where(table.c.id.in_(ids))
+
+        try:
+            if supports_returning():
+                deleted = [
+                    row.id for row in db.session.execute(
+                        statement.returning(table.c.id))
+                ]
+            else:
+                deleted = [
+                    row.id for row in db.session.execute(
+                        select([table.c.id]).where(table.c.id.in_(ids)))
+                ]
+                db.session.execute(statement)
+
+            if deleted:
+                bump_version(table.name, row_delta=-len(deleted))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        return deleted
+
+    @classmethod
+    def get_row(cls, id):
+        '''Loads one row with a Core SELECT, without an ORM instance.
+
+        Returns:
+            The row formatted like format(), or None if there is no
+            row with that ID.
+        '''
+        table = cls.__table__
+        row = db.session.execute(
+            table.select().where(table.c.id == id)).fetchone()
+
+        return cls.format_row(row) if row is not None else None
+
+    @classmethod
+    def format_row(cls, row, fields=None):
+        '''Formats a Core result row the same way as format().
+
+        Args:
+            row: a result row holding the model's columns.
+            fields: optional column names to keep, instead of every
+                column.
+        '''
+        if fields is None:
+            fields = cls.__table__.c.keys()
+        return {name: row[name] for name in fields}
 
 
 # Define the Models for the databases
-class Movie(db.Model):
+class Movie(BulkOpsMixin, db.Model):
     __tablename__ = "movies"
 
     id = Column(Integer, primary_key=True)
-    title = Column(String)
-    release_date = Column(DateTime)
+    title = Column(String, index=True)
+    release_date = Column(DateTime, index=True)
 
     def __init__(self, title, release_date):
         self.title = title
@@ -37,23 +478,26 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_version(self.__tablename__, row_delta=1)
         db.session.commit()
 
     def update(self):
+        bump_version(self.__tablename__)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_version(self.__tablename__, row_delta=-1)
         db.session.commit()
 
 
-class Actor(db.Model):
+class Actor(BulkOpsMixin, db.Model):
     __tablename__ = 'actors'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String)
-    age = Column(Integer)
-    gender = Column(String)
+    name = Column(String, index=True)
+    age = Column(Integer, index=True)
+    gender = Column(String, index=True)
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -70,11 +514,213 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_version(self.__tablename__, row_delta=1)
         db.session.commit()
 
     def update(self):
+        bump_version(self.__tablename__)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_version(self.__tablename__, row_delta=-1)
+        db.session.commit()
+
+
+# Cast
+'''
+cast_members associates movies with the actors cast in them. Rows are
+removed along with their movie or actor by ON DELETE CASCADE. Related
+rows are loaded for a whole page of movies or actors at once, the way
+selectinload does, so including them costs one query per page rather
+than one per row.
+'''
+cast_members = db.Table(
+    'cast_members',
+    Column('movie_id',
+           Integer,
+           ForeignKey('movies.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('actor_id',
+           Integer,
+           ForeignKey('actors.id', ondelete='CASCADE'),
+           primary_key=True,
+           index=True))
+
+
+def related_rows(model, ids):
+    '''Loads the rows related to each of the given IDs in one query.
+
+    Movies are related to the actors cast in them, and actors to the
+    movies they are cast in.
+
+    Args:
+        model: Movie or Actor, the model the IDs belong to.
+        ids: the IDs to load related rows for.
+
+    Returns:
+        A dict mapping each ID to a list of related rows formatted
+        like format(), ordered by ID.
+    '''
+    if model is Movie:
+        own, other, related = 'movie_id', 'actor_id', Actor
+    else:
+        own, other, related = 'actor_id', 'movie_id', Movie
+
+    rows = {id: [] for id in ids}
+    if not rows:
+        return rows
+
+    table = related.__table__
+    statement = select([cast_members.c[own]] + list(table.c)).select_from(
+        table.join(cast_members, cast_members.c[other] == table.c.id)).where(
+            cast_members.c[own].in_(rows)).order_by(cast_members.c[own],
+                                                    table.c.id)
+    for row in db.session.execute(statement):
+        rows[row[own]].append(related.format_row(row))
+
+    return rows
+
+
+def add_cast_member(movie_id, actor_id):
+    '''Casts an actor in a movie, unless they already are.
+
+    On PostgreSQL the INSERT skips an existing row with ON CONFLICT DO
+    NOTHING, so two requests adding the same actor at once cannot
+    both insert it. Other databases check for the row first.
+
+    Returns:
+        True if the actor was added to the cast, False if they were
+        already in it.
+    '''
+    values = {'movie_id': movie_id, 'actor_id': actor_id}
+
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            added = db.session.execute(
+                postgresql.insert(cast_members).values(
+                    values).on_conflict_do_nothing()).rowcount > 0
+        else:
+            exists = select([literal(1)]).where(
+                and_(cast_members.c.movie_id == movie_id,
+                     cast_members.c.actor_id == actor_id))
+            added = db.session.execute(exists).first() is None
+            if added:
+                db.session.execute(cast_members.insert().values(values))
+
+        if added:
+            bump_version(cast_members.name)
         db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return added
+
+
+def remove_cast_member(movie_id, actor_id):
+    '''Removes an actor from the cast of a movie.
+
+    Returns:
+        True if the actor was removed, False if they were not in the
+        cast.
+    '''
+    statement = cast_members.delete().where(
+        and_(cast_members.c.movie_id == movie_id,
+             cast_members.c.actor_id == actor_id))
+
+    try:
+        deleted = db.session.execute(statement).rowcount > 0
+        if deleted:
+            bump_version(cast_members.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return deleted
+
+
+# Search
+'''
+Searches match movie titles and actor names by word prefix. On
+PostgreSQL they use full-text search over to_tsvector('simple', ...)
+GIN indexes and, when the pg_trgm extension is installed, trigram word
+similarity so misspellings still match. Other databases fall back to a
+LIKE scan ranking exact, then prefix, then substring matches.
+'''
+SEARCH_COLUMNS = {'movies': 'title', 'actors': 'name'}
+
+_trigram_support = {}
+
+
+def pg_trgm_available(ddl, target, bind, **kwargs):
+    '''Whether the pg_trgm extension can be created on the database.'''
+    return bind.dialect.name == 'postgresql' and bind.execute(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    ).scalar() is not None
+
+
+event.listen(
+    db.metadata, 'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public').execute_if(
+        callable_=pg_trgm_available))
+
+for table_name, column_name in SEARCH_COLUMNS.items():
+    table = db.metadata.tables[table_name]
+    event.listen(
+        table, 'after_create',
+        DDL(f'CREATE INDEX ix_{table_name}_{column_name}_fts ON {table_name} '
+            f"USING gin (to_tsvector('simple', {column_name}))").execute_if(
+                dialect='postgresql'))
+    event.listen(
+        table, 'after_create',
+        DDL(f'CREATE INDEX ix_{table_name}_{column_name}_trgm '
+            f'ON {table_name} USING gin ({column_name} gin_trgm_ops)'
+            ).execute_if(callable_=pg_trgm_available))
+
+
+def has_trigram():
+    '''Whether pg_trgm is installed, checked once per database.'''
+    url = str(db.engine.url)
+    if url not in _trigram_support:
+        _trigram_support[url] = db.session.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").scalar(
+            ) is not None
+    return _trigram_support[url]
+
+
+def search(model, text, limit):
+    '''Returns the rows of a model matching text, most relevant first.
+
+    Args:
+        model: Movie or Actor, searched by title or name.
+        text: the words to search for.
+        limit: maximum number of rows to return.
+
+    Returns:
+        A list of rows formatted like format().
+    '''
+    table = model.__table__
+    column = table.c[SEARCH_COLUMNS[table.name]]
+
+    if db.engine.dialect.name == 'postgresql':
+        words = re.findall(r'\w+', text.lower())
+        vector = func.to_tsvector('simple', column)
+        query = func.to_tsquery('simple',
+                                ' & '.join(f'{word}:*' for word in words))
+        condition = vector.op('@@')(query)
+        rank = func.ts_rank(vector, query)
+        if has_trigram():
+            condition = or_(condition, literal(text).op('<%')(column))
+            rank = rank + func.word_similarity(text, column)
+    else:
+        escaped = re.sub(r'([\\%_])', r'\\\1', text.lower())
+        condition = column.ilike(f'%{escaped}%', escape='\\')
+        rank = case([(func.lower(column) == text.lower(), 3),
+                     (column.ilike(f'{escaped}%', escape='\\'), 2)],
+                    else_=1)
+
+    statement = select([table]).where(condition).order_by(
+        rank.desc(), func.length(column), table.c.id).limit(limit)
+    return [model.format_row(row) for row in db.session.execute(statement)]
@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import Pool, QueuePool
+
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+DB_POOL_TIMEOUT = 30
+# Connections are replaced after this many seconds, before PgBouncer or
+# a firewall drops them for being idle. -1 keeps them forever.
+DB_POOL_RECYCLE = 1800
+DB_POOL_PRE_PING = True
+# Milliseconds a statement may run before PostgreSQL cancels it, 0 for
+# no limit
+DB_STATEMENT_TIMEOUT = 0
+
+
+def env_flag(name, default):
+    '''Reads a boolean environment variable such as 1/0 or true/false.'''
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def pool_config():
+    '''Returns the DB_* pool settings, read from the environment.'''
+    return {
+        'DB_POOL_SIZE':
+        int(os.environ.get('DB_POOL_SIZE', DB_POOL_SIZE)),
+        'DB_MAX_OVERFLOW':
+        int(os.environ.get('DB_MAX_OVERFLOW', DB_MAX_OVERFLOW)),
+        'DB_POOL_TIMEOUT':
+        int(os.environ.get('DB_POOL_TIMEOUT', DB_POOL_TIMEOUT)),
+        'DB_POOL_RECYCLE':
+        int(os.environ.get('DB_POOL_RECYCLE', DB_POOL_RECYCLE)),
+        'DB_POOL_PRE_PING':
+        env_flag('DB_POOL_PRE_PING', DB_POOL_PRE_PING),
+        'DB_STATEMENT_TIMEOUT':
+        int(os.environ.get('DB_STATEMENT_TIMEOUT', DB_STATEMENT_TIMEOUT))
+    }
+
+
+def engine_options(config, backend):
+    '''Builds the create_engine options for the DB_* settings.
+
+    Pool sizes only apply to the QueuePool used for server databases;
+    SQLite keeps the pool Flask-SQLAlchemy picks for it. The statement
+    timeout is sent as a connection option on PostgreSQL.
+    '''
+    options = {
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'pool_recycle': config['DB_POOL_RECYCLE']
+    }
+    if backend != 'sqlite':
+        options.update(poolclass=TimedQueuePool,
+                       pool_size=config['DB_POOL_SIZE'],
+                       max_overflow=config['DB_MAX_OVERFLOW'],
+                       pool_timeout=config['DB_POOL_TIMEOUT'])
+    if backend == 'postgresql' and config['DB_STATEMENT_TIMEOUT']:
+        options['connect_args'] = {
+            'options':
+            f'-c statement_timeout={config["DB_STATEMENT_TIMEOUT"]}'
+        }
+    return options
+
+
+# Pool Telemetry
+'''
+PoolStats
+Counts checkouts from the connection pool of this process, how long
+they waited for a connection and how often the pool was saturated.
+A checkout is saturated when all pool_size connections are in use: it
+either opens an overflow connection or, once max_overflow is reached,
+waits for another request to return one. Waits and timeouts growing under
+load mean workers need more connections than the pool (or PostgreSQL's
+max_connections) allows.
+'''
+
+
+class PoolStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.overflow_checkouts = 0
+            self.waits = 0
+            self.timeouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+            self.peak_checked_out = 0
+            self.invalidations = 0
+
+    def record_checkout(self, wait, overflowed, waited, checked_out):
+        with self._lock:
+            self.checkouts += 1
+            self.overflow_checkouts += overflowed
+            self.waits += waited
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+
+    def record_timeout(self, wait):
+        with self._lock:
+            self.timeouts += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def record_invalidation(self, *args):
+        with self._lock:
+            self.invalidations += 1
+
+    def stats(self, pool):
+        stats = {
+            'pool': type(pool).__name__,
+            'checkouts': self.checkouts,
+            'overflow_checkouts': self.overflow_checkouts,
+            'waits': self.waits,
+            'timeouts': self.timeouts,
+            'wait_seconds_total': self.wait_seconds,
+            'wait_seconds_max': self.max_wait_seconds,
+            'wait_seconds_avg':
+            self.wait_seconds / self.checkouts if self.checkouts else 0.0,
+            'peak_checked_out': self.peak_checked_out,
+            'invalidations': self.invalidations
+        }
+        if isinstance(pool, QueuePool):
+            stats.update(size=pool.size(),
+                         max_overflow=pool._max_overflow,
+                         checked_out=pool.checkedout(),
+                         idle=pool.checkedin(),
+                         overflow=max(pool.overflow(), 0))
+        return stats
+
+
+pool_stats = PoolStats()
+event.listen(Pool, 'invalidate', pool_stats.record_invalidation)
+_checkout = threading.local()
+
+
+class TimedQueuePool(QueuePool):
+    '''QueuePool recording checkout waits and saturation in pool_stats.'''
+    def _do_get(self):
+        # QueuePool retries by calling _do_get again, time only the
+        # outermost call
+        if getattr(_checkout, 'timing', False):
+            return super()._do_get()
+
+        # Saturated when every connection up to pool_size is in use
+        overflowed = self.checkedin() == 0 and self.overflow() >= 0
+        waited = overflowed and (self._max_overflow > -1
+                                 and self.overflow() >= self._max_overflow)
+        start = time.perf_counter()
+        _checkout.timing = True
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            pool_stats.record_timeout(time.perf_counter() - start)
+            raise
+        finally:
+            _checkout.timing = False
+
+        pool_stats.record_checkout(time.perf_counter() - start,
+                                   overflowed and not waited, waited,
+                                   self.checkedout())
+        return connection
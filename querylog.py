@@ -0,0 +1,143 @@
+import os
+import re
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from pool import env_flag
+
+QUERY_LOG = False
+SLOW_QUERY_MS = 100
+# Number of times one statement shape may run in a request before it
+# is reported as a likely N+1
+N_PLUS_ONE_THRESHOLD = 3
+QUERY_BUDGET_STRICT = False
+
+BIND_PARAMETER = re.compile(r'%\(\w+\)s|:\w+|\?')
+# Like BEGIN and COMMIT, which never reach the cursor, savepoints are
+# not counted as queries
+SAVEPOINT = re.compile(r'\s*(RELEASE |ROLLBACK TO )?SAVEPOINT ', re.I)
+PARAMETER_LIST = re.compile(r'\(\?(?:, \?)+\)')
+
+
+class QueryBudgetExceeded(Exception):
+    '''Raised in strict mode by a route running over its query budget.'''
+
+
+def statement_shape(statement):
+    '''Normalizes a statement so executions differing only in their
+    parameters, or the length of an IN list, compare equal.'''
+    shape = BIND_PARAMETER.sub('?', ' '.join(statement.split()))
+    return PARAMETER_LIST.sub('(?)', shape)
+
+
+def query_budget(max_queries):
+    '''Decorator declaring the most statements a route may run.
+
+    Budgets are only checked while the query log is enabled.
+    '''
+    def query_budget_decorator(f):
+        f.query_budget = max_queries
+        return f
+
+    return query_budget_decorator
+
+
+# Query Log
+'''
+QueryLog
+Opt-in development aid recording every statement a request runs, via
+before/after_cursor_execute. After each request it logs the statements
+slower than SLOW_QUERY_MS with their parameters, and statement shapes
+repeated N_PLUS_ONE_THRESHOLD times or more, which usually means rows
+are loaded one query at a time. Routes exceeding their query_budget
+are logged too or, with QUERY_BUDGET_STRICT, raise QueryBudgetExceeded
+so the test suite fails.
+'''
+
+
+class QueryLog:
+    def init_app(self, app):
+        config = {
+            'QUERY_LOG':
+            env_flag('QUERY_LOG', QUERY_LOG),
+            'SLOW_QUERY_MS':
+            float(os.environ.get('SLOW_QUERY_MS', SLOW_QUERY_MS)),
+            'N_PLUS_ONE_THRESHOLD':
+            int(os.environ.get('N_PLUS_ONE_THRESHOLD', N_PLUS_ONE_THRESHOLD)),
+            'QUERY_BUDGET_STRICT':
+            env_flag('QUERY_BUDGET_STRICT', QUERY_BUDGET_STRICT)
+        }
+        for key, value in config.items():
+            app.config.setdefault(key, value)
+        if not app.config['QUERY_LOG']:
+            return
+
+        # Listening on the Engine class covers engines Flask-SQLAlchemy
+        # creates later, e.g. when the database URI changes
+        if not event.contains(Engine, 'before_cursor_execute',
+                              self.before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         self.after_cursor_execute)
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.extensions['query_log'] = self
+
+    def start_request(self):
+        g.query_log = []
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        if context is not None:
+            context.query_log_start = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        start = getattr(context, 'query_log_start', None)
+        if start is None or SAVEPOINT.match(statement):
+            return
+        if has_request_context() and 'query_log' in g:
+            g.query_log.append(
+                (statement, parameters, time.perf_counter() - start))
+
+    def finish_request(self, response):
+        queries = g.pop('query_log', None)
+        if queries is None:
+            return response
+
+        config = current_app.config
+        logger = current_app.logger
+        route = f'{request.method} {request.path}'
+
+        for statement, parameters, duration in queries:
+            if duration * 1000 >= config['SLOW_QUERY_MS']:
+                logger.warning('Slow query (%.1f ms) in %s: %s %r',
+                               duration * 1000, route, statement, parameters)
+
+        shapes = Counter(
+            statement_shape(statement) for statement, _, _ in queries)
+        for shape, count in shapes.items():
+            if count >= config['N_PLUS_ONE_THRESHOLD']:
+                logger.warning('Possible N+1 in %s: %d x %s', route, count,
+                               shape)
+
+        response.headers['X-Query-Count'] = str(len(queries))
+
+        view = current_app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', None)
+        if budget is not None and len(queries) > budget:
+            message = (f'{route} ran {len(queries)} queries, over its '
+                       f'budget of {budget}')
+            if config['QUERY_BUDGET_STRICT']:
+                raise QueryBudgetExceeded(message)
+            logger.error(message)
+
+        return response
+
+
+query_log = QueryLog()
@@ -1,55 +1,213 @@
+import io
 import os
+import runpy
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+from unittest import mock
 import json
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+from jose import jwt
+from prometheus_client import REGISTRY, CollectorRegistry
+from prometheus_client.multiprocess import MultiProcessCollector
+from flask import _app_ctx_stack
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.pool import QueuePool
 
-from app import create_app
-from models import setup_db, Actor, Movie
+import auth
+import transfer
+from app import create_app, encode_cursor
+from cache import MemoryCache, SQLiteCache
+from pool import TimedQueuePool, pool_stats
+from querylog import QueryBudgetExceeded, query_budget, statement_shape
+from models import (db, add_cast_member, bump_version, cast_members, Actor,
+                    Movie, TableVersion)
+from auth import (AuthError, JWKSStore, JWKSFileStore, LocalKeyPair,
+                  TokenCache, check_permissions, mint_token, set_key_source)
 
-TOKEN_ASSISTANT = os.environ['TOKEN_ASSISTANT']
-TOKEN_DIRECTOR = os.environ['TOKEN_DIRECTOR']
-TOKEN_PRODUCER = os.environ['TOKEN_PRODUCER']
+# Generating a 2048-bit key takes seconds, a shorter one is fine for tests
+KEY_PAIR = LocalKeyPair(bits=1024)
 
+if 'TOKEN_ASSISTANT' in os.environ:
+    TOKEN_ASSISTANT = os.environ['TOKEN_ASSISTANT']
+    TOKEN_DIRECTOR = os.environ['TOKEN_DIRECTOR']
+    TOKEN_PRODUCER = os.environ['TOKEN_PRODUCER']
+else:
+    # No Auth0 tokens given, verify against a local key pair instead,
+    # here and in the processes the tests start
+    os.environ.setdefault('AUTH_KEY_SOURCE', 'local')
+    set_key_source(KEY_PAIR)
+    TOKEN_ASSISTANT = mint_token('assistant')
+    TOKEN_DIRECTOR = mint_token('director')
+    TOKEN_PRODUCER = mint_token('producer')
 
-class CastingApiTestCase(unittest.TestCase):
-    '''Test case for the Casting Agency API.'''
-    def setUp(self):
-        '''Executes before each test. Set variables and init app.'''
-        self.app = create_app()
-        self.client = self.app.test_client
-        self.database_url = os.environ['DATABASE_URL']
-        setup_db(self.app, self.database_url)
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def worker_database_url():
+    '''Returns the database URL for this test process.
+
+    Under pytest-xdist every worker gets a PostgreSQL schema of its
+    own, selected with search_path, or a SQLite file of its own, so
+    workers never see each other's rows or fight over the same
+    migrations.
+    '''
+    url = os.environ['DATABASE_URL']
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    if worker is None or is_in_memory(url):
+        return url, None
+
+    if make_url(url).get_backend_name() == 'sqlite':
+        worker_url = make_url(url)
+        root, ext = os.path.splitext(worker_url.database)
+        worker_url.database = f'{root}-{worker}{ext}'
+        return str(worker_url), None
+
+    if make_url(url).get_backend_name() != 'postgresql':
+        return url, None
+
+    schema = f'test_{worker}'
+    separator = '&' if '?' in url else '?'
+    return f'{url}{separator}options=-csearch_path={schema},public', schema
+
+
+def is_in_memory(url):
+    url = make_url(url)
+    return (url.get_backend_name() == 'sqlite'
+            and url.database in (None, '', ':memory:'))
+
+
+# SQLite gets a NullPool or SingletonThreadPool instead of a QueuePool
+requires_server_database = unittest.skipIf(
+    make_url(os.environ.get('DATABASE_URL',
+                            'sqlite://')).get_backend_name() == 'sqlite',
+    'needs a database server')
+
+requires_postgresql = unittest.skipUnless(
+    make_url(os.environ.get('DATABASE_URL',
+                            'sqlite://')).get_backend_name() == 'postgresql',
+    'needs PostgreSQL')
+
+
+def setUpModule():
+    '''Creates the schema of the test database with the migrations.
+
+    An in-memory SQLite database only lives as long as its engine, so
+    TransactionalTestCase creates its tables for every test instead.
+    '''
+    url, schema = worker_database_url()
+    if is_in_memory(url):
+        return
+
+    if schema is not None:
+        engine = create_engine(os.environ['DATABASE_URL'])
+        with engine.begin() as connection:
+            # Workers start together: install pg_trgm into public one at
+            # a time, before any migration could create it elsewhere
+            connection.execute("SELECT pg_advisory_xact_lock(hashtext('"
+                               "casting-test-setup'))")
+            if connection.execute(
+                    'SELECT 1 FROM pg_available_extensions '
+                    "WHERE name = 'pg_trgm'").scalar() is not None:
+                connection.execute(
+                    'CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public')
+            connection.execute(f'CREATE SCHEMA IF NOT EXISTS {schema}')
+        engine.dispose()
+    os.environ['DATABASE_URL'] = url
+    subprocess.run([sys.executable, 'manage.py', 'db', 'upgrade'],
+                   cwd=ROOT,
+                   check=True,
+                   stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+
+
+def restart_savepoint(session, transaction):
+    '''Begins a new SAVEPOINT once the app commits or rolls back.'''
+    if transaction.nested and not transaction._parent.nested:
+        session.begin_nested()
+
+
+class TransactionalTestCase(unittest.TestCase):
+    '''Test case running each test in a transaction rolled back after.
 
+    Sessions are bound to one connection inside an outer transaction
+    and work within a SAVEPOINT, which the app's commits and rollbacks
+    end and restart_savepoint begins again. Nothing a test writes is
+    ever committed, so there is nothing to delete in tearDown and tests
+    can run in parallel against the same database.
+    '''
+    config = {}
+
+    def setUp(self):
+        self.app = create_app(self.config)
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            self.db.create_all()
-
-        new_actor = Actor(name='Test_Name', age=31, gender='f')
-        new_actor.insert()
-        new_actor = Actor.query.filter(
-            Actor.name.ilike('%Test_Name%')).one_or_none()
-        global actor_id
-        actor_id = new_actor.id
-
-        new_movie = Movie(title='Test_Title', release_date='2012-02-14')
-        new_movie.insert()
-        new_movie = Movie.query.filter(
-            Movie.title.ilike('%Test_Title%')).one_or_none()
-        global movie_id
-        movie_id = new_movie.id
+            engine = db.engine
+        if engine.dialect.name == 'sqlite':
+            # pysqlite starts transactions late and breaks SAVEPOINTs
+            # unless it is left to SQLAlchemy to emit BEGIN
+            event.listen(engine, 'connect', self.sqlite_autocommit)
+            event.listen(engine, 'begin', self.sqlite_begin)
+
+        self.connection = engine.connect()
+        self.connection.begin()
+        if is_in_memory(str(engine.url)):
+            db.metadata.create_all(self.connection)
+
+        session_factory = db.session.session_factory
+        connection = self.connection
+
+        def create_session():
+            session = session_factory(bind=connection, binds={})
+            session.begin_nested()
+            event.listen(session, 'after_transaction_end', restart_savepoint)
+            return session
+
+        self.session = db.session
+        db.session = scoped_session(create_session,
+                                    scopefunc=_app_ctx_stack.__ident_func__)
 
     def tearDown(self):
-        '''Executes after each test. Cleans up test data'''
-        remove_actors = Actor.query.all()
-        if remove_actors:
-            for actor in remove_actors:
-                actor.delete()
+        db.session.remove()
+        db.session = self.session
+        # Returning the connection to the pool rolls back the outer
+        # transaction and every SAVEPOINT the sessions left open in it
+        self.connection.close()
+
+    @staticmethod
+    def sqlite_autocommit(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @staticmethod
+    def sqlite_begin(connection):
+        connection.execute('BEGIN')
+
+
+class CastingApiTestCase(TransactionalTestCase):
+    '''Test case for the Casting Agency API.'''
+    # Fail any test whose requests go over a route's query budget
+    config = {'TESTING': True, 'QUERY_LOG': True, 'QUERY_BUDGET_STRICT': True}
 
-        remove_movies = Movie.query.all()
-        if remove_movies:
-            for movie in remove_movies:
-                movie.delete()
+    def setUp(self):
+        '''Executes before each test. Set variables and init app.'''
+        super().setUp()
+        self.client = self.app.test_client
+
+        global actor_id, movie_id
+        actor_id, = Actor.bulk_insert([{
+            'name': 'Test_Name',
+            'age': 31,
+            'gender': 'f'
+        }])
+        movie_id, = Movie.bulk_insert([{
+            'title': 'Test_Title',
+            'release_date': datetime(2012, 2, 14)
+        }])
 
     # Success behaviour tests
     def test_get_actors_success(self):
@@ -72,6 +230,339 @@ class CastingApiTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['movies'])
 
+    def test_get_movies_matches_format(self):
+        '''Test the movie reads return the same JSON as format()'''
+        with self.app.app_context():
+            expected = json.loads(
+                self.app.json_encoder().encode(
+                    Movie.query.get(movie_id).format()))
+
+        response = self.client().get('/movies')
+        self.assertEqual(json.loads(response.data)['movies'], [expected])
+
+        response = self.client().get(f'/movies/{movie_id}')
+        self.assertEqual(json.loads(response.data)['movie'], expected)
+
+        response = self.client().get('/movies/export')
+        self.assertEqual(json.loads(response.data), expected)
+
+    def test_get_actors_keyset_pagination(self):
+        '''Test following the next cursor through the actors'''
+        Actor(name='Test_Second', age=40, gender='m').insert()
+        headers = {'Authorization': f'Bearer {str(TOKEN_ASSISTANT)}'}
+
+        response = self.client().get('/actors?limit=1', headers=headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertEqual(data['actors'][0]['id'], actor_id)
+        self.assertTrue(data['next_cursor'])
+
+        response = self.client().get(
+            f'/actors?limit=1&after={data["next_cursor"]}', headers=headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['actors'][0]['name'], 'Test_Second')
+        self.assertIsNone(data['next_cursor'])
+
+    def test_export_actors(self):
+        '''Test streaming every actor as NDJSON'''
+        Actor(name='Test_Export', age=50, gender='m').insert()
+        response = self.client().get('/actors/export')
+        lines = response.get_data(as_text=True).splitlines()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['name'] for line in lines],
+                         ['Test_Name', 'Test_Export'])
+
+    def test_export_movies(self):
+        '''Test streaming every movie as NDJSON'''
+        response = self.client().get('/movies/export')
+        lines = response.get_data(as_text=True).splitlines()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(lines[0])['id'], movie_id)
+
+    def test_export_import_table_round_trip(self):
+        '''Test reloading a table from its CSV export'''
+        out_file = io.StringIO()
+        with self.app.app_context():
+            exported = transfer.export_table('movies', out_file, 'csv')
+            Movie.query.get(movie_id).delete()
+            out_file.seek(0)
+            imported = transfer.import_table('movies', out_file, 'csv')
+
+        self.assertEqual(exported, 1)
+        self.assertEqual(imported, 1)
+        self.assertEqual(Movie.query.get(movie_id).title, 'Test_Title')
+
+    def test_get_actor_success(self):
+        '''Test retrieving a single actor'''
+        response = self.client().get(f'/actors/{actor_id}')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['actor']['name'], 'Test_Name')
+        self.assertTrue(response.headers.get('ETag'))
+
+    def test_get_movies_not_modified(self):
+        '''Test conditional GET of movies until a movie changes'''
+        response = self.client().get('/movies')
+        etag = response.headers['ETag']
+
+        response = self.client().get('/movies',
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        edit_movie = Movie.query.get(movie_id)
+        edit_movie.title = 'Test_Changed'
+        edit_movie.update()
+
+        response = self.client().get('/movies',
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_get_movies_not_modified_weak(self):
+        '''Test conditional GET of movies with a weak validator'''
+        response = self.client().get('/movies')
+        etag = response.headers['ETag']
+
+        response = self.client().get('/movies',
+                                     headers={'If-None-Match': f'W/{etag}'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_get_actors_cached_until_write(self):
+        '''Test actors are served from the cache until an actor is added'''
+        client = create_app({'RESPONSE_CACHE_BACKEND': 'memory'}).test_client()
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+
+        self.assertEqual(client.get('/actors').headers['X-Cache'], 'MISS')
+        self.assertEqual(client.get('/actors').headers['X-Cache'], 'HIT')
+
+        client.post('/actors',
+                    headers=headers,
+                    json={
+                        'name': 'Cache_Buster',
+                        'age': 22,
+                        'gender': 'f'
+                    })
+        response = client.get('/actors')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(data['total_actors'], 2)
+        stats = json.loads(client.get('/cache/stats').data)['cache']
+        self.assertEqual(stats['hits'], 1)
+
+    def test_get_actors_cached_not_modified_weak(self):
+        '''Test a cached response is a 304 for a weak validator'''
+        client = create_app({'RESPONSE_CACHE_BACKEND': 'memory'}).test_client()
+        etag = client.get('/actors').headers['ETag']
+
+        response = client.get('/actors',
+                              headers={'If-None-Match': f'W/{etag}'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_cache_key_keeps_encoded_arguments_apart(self):
+        '''Test an encoded & does not hit the entry of two arguments'''
+        client = create_app({'RESPONSE_CACHE_BACKEND': 'memory'}).test_client()
+
+        response = client.get('/actors?gender=f&name=Test_Name')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+
+        response = client.get('/actors?gender=f%26name%3DTest_Name')
+        self.assertEqual(response.status_code, 404)
+        self.assertNotEqual(response.headers.get('X-Cache'), 'HIT')
+
+    def test_get_actors_filtered_and_sorted(self):
+        '''Test filtering actors by age and gender and sorting them'''
+        Actor.bulk_insert([{
+            'name': 'Test_Older',
+            'age': 60,
+            'gender': 'f'
+        }, {
+            'name': 'Test_Male',
+            'age': 45,
+            'gender': 'm'
+        }, {
+            'name': 'Test_Middle',
+            'age': 40,
+            'gender': 'f'
+        }])
+
+        response = self.client().get(
+            '/actors?gender=f&min_age=35&sort=-age')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         ['Test_Older', 'Test_Middle'])
+        self.assertEqual(data['total_actors'], 2)
+
+    @requires_postgresql
+    def test_total_actors_from_row_count(self):
+        '''Test unfiltered totals come from the maintained row count'''
+        ids = Actor.bulk_insert([{
+            'name': f'Test_Counted_{i}',
+            'age': 20 + i,
+            'gender': 'm'
+        } for i in range(3)])
+        Actor.bulk_delete(ids[:2])
+        Actor.query.get(ids[2]).delete()
+        self.assertEqual(
+            TableVersion.query.get('actors').row_count, Actor.query.count())
+
+        versions = TableVersion.__table__
+        db.session.execute(versions.update().where(
+            versions.c.table_name == 'actors').values(row_count=42))
+        bump_version('actors')
+        db.session.commit()
+
+        response = self.client().get('/actors')
+        self.assertEqual(json.loads(response.data)['total_actors'], 42)
+        response = self.client().get('/actors?gender=f')
+        self.assertEqual(json.loads(response.data)['total_actors'], 1)
+
+    def test_get_actors_count_estimate(self):
+        '''Test estimated totals of actors, filtered or not'''
+        for path in ('/actors?count=estimate',
+                     '/actors?count=estimate&gender=f'):
+            response = self.client().get(path)
+            data = json.loads(response.data)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertIsInstance(data['total_actors'], int)
+
+    def test_search_ranks_matches(self):
+        '''Test searching titles and names by word prefix'''
+        Movie.bulk_insert([{
+            'title': 'Test_Title Returns',
+            'release_date': datetime(2015, 5, 1)
+        }, {
+            'title': 'Unrelated',
+            'release_date': datetime(2016, 6, 1)
+        }])
+
+        response = self.client().get('/search?q=test_tit')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([movie['title'] for movie in data['movies']],
+                         ['Test_Title', 'Test_Title Returns'])
+        self.assertEqual(data['actors'], [])
+
+        response = self.client().get('/search?q=test_name&type=actors')
+        data = json.loads(response.data)
+
+        self.assertEqual(data['actors'][0]['id'], actor_id)
+        self.assertNotIn('movies', data)
+
+    def test_movie_cast(self):
+        '''Test casting an actor in a movie and removing them again'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        response = self.client().post(f'/movies/{movie_id}/cast',
+                                      json={'actor_id': actor_id},
+                                      headers=headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['cast']], [actor_id])
+
+        response = self.client().get(f'/actors/{actor_id}/movies')
+        data = json.loads(response.data)
+        self.assertEqual([movie['id'] for movie in data['movies']],
+                         [movie_id])
+
+        response = self.client().delete(
+            f'/movies/{movie_id}/cast/{actor_id}', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client().get(f'/movies/{movie_id}/cast')
+        data = json.loads(response.data)
+        self.assertEqual(data['movie']['id'], movie_id)
+        self.assertEqual(data['cast'], [])
+
+    def test_movie_cast_twice_and_bool_actor_id(self):
+        '''Test recasting is a no-op and true is not an actor ID'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        self.assertTrue(add_cast_member(movie_id, actor_id))
+        self.assertFalse(add_cast_member(movie_id, actor_id))
+
+        response = self.client().post(f'/movies/{movie_id}/cast',
+                                      json={'actor_id': actor_id},
+                                      headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)['cast']), 1)
+
+        response = self.client().post(f'/movies/{movie_id}/cast',
+                                      json={'actor_id': True},
+                                      headers=headers)
+        self.assertEqual(response.status_code, 422)
+
+    def test_delete_actor_removes_cast_members(self):
+        '''Test deleting an actor takes them out of every cast'''
+        add_cast_member(movie_id, actor_id)
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        response = self.client().delete(f'/actors/{actor_id}', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        rows = db.session.execute(cast_members.select().where(
+            cast_members.c.actor_id == actor_id)).fetchall()
+        self.assertEqual(rows, [])
+        response = self.client().get(f'/movies/{movie_id}/cast')
+        self.assertEqual(json.loads(response.data)['cast'], [])
+
+    def test_get_movies_include_cast_query_count(self):
+        '''Test including the cast costs the same queries for any page'''
+        ids = Movie.bulk_insert([{
+            'title': f'Test_Cast_{i}',
+            'release_date': datetime(2010 + i, 1, 1)
+        } for i in range(4)])
+        for id in [movie_id] + ids:
+            add_cast_member(id, actor_id)
+
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            response = self.client().get('/movies?include=cast&limit=1')
+            one_page = len(statements)
+            del statements[:]
+            response = self.client().get('/movies?include=cast&limit=5')
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        data = json.loads(response.data)
+
+        self.assertEqual(len(data['movies']), 5)
+        self.assertTrue(
+            all(movie['cast'][0]['id'] == actor_id
+                for movie in data['movies']))
+        self.assertEqual(len(statements), one_page)
+
+    def test_get_actors_sparse_fields(self):
+        '''Test returning only the requested actor fields'''
+        Actor(name='Test_Second', age=40, gender='m').insert()
+        response = self.client().get('/actors?fields=name&limit=1')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['actors'], [{'name': 'Test_Name'}])
+        self.assertTrue(data['next_cursor'])
+
     def test_post_actor_success(self):
         '''Test successfully adding new actor'''
         headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
@@ -99,6 +590,75 @@ class CastingApiTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(payload['title'], movie.title)
+        self.assertEqual(data['movie']['id'], movie.id)
+        self.assertTrue(response.headers['Location'].endswith(
+            f'/movies/{movie.id}'))
+        self.assertNotIn('movies', data)
+
+    def test_post_actor_return_all(self):
+        '''Test adding an actor and listing all actors on request'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        payload = {'name': 'Bozwil', 'age': 43, 'gender': 'f'}
+
+        response = self.client().post('/actors?return=all',
+                                      headers=headers,
+                                      json=payload)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['actor']['name'], 'Bozwil')
+        self.assertEqual(len(data['actors']), 2)
+
+    def test_post_actors_bulk(self):
+        '''Test adding actors in bulk with per-item errors'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        payload = [{
+            'name': 'Bulk_One',
+            'age': 20,
+            'gender': 'f'
+        }, {
+            'name': 'Bulk_Bad',
+            'gender': 'm'
+        }, {
+            'name': 'Bulk_Two',
+            'age': 30,
+            'gender': 'm'
+        }]
+
+        response = self.client().post('/actors/bulk',
+                                      headers=headers,
+                                      json=payload)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_created'], 2)
+        self.assertEqual([item['index'] for item in data['created']], [0, 2])
+        self.assertEqual(data['errors'][0]['index'], 1)
+        actor = Actor.query.get(data['created'][1]['id'])
+        self.assertEqual(actor.name, 'Bulk_Two')
+
+    def test_post_movies_bulk_ndjson(self):
+        '''Test adding movies in bulk from an NDJSON body'''
+        headers = {
+            'Authorization': f'Bearer {str(TOKEN_PRODUCER)}',
+            'Content-Type': 'application/x-ndjson'
+        }
+        body = '\n'.join([
+            json.dumps({'title': 'Bulk_Movie', 'release_date': '2020-01-02'}),
+            'not json',
+            json.dumps({'title': 'Bulk_Movie_2', 'release_date': 'soon'})
+        ])
+
+        response = self.client().post('/movies/bulk',
+                                      headers=headers,
+                                      data=body)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_created'], 1)
+        self.assertEqual([item['index'] for item in data['errors']], [1, 2])
+        movie = Movie.query.get(data['created'][0]['id'])
+        self.assertEqual(movie.title, 'Bulk_Movie')
 
     def test_patch_actor_success(self):
         '''Test successfully modifying record for an actor'''
@@ -115,6 +675,7 @@ class CastingApiTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(payload['name'], actor.name)
+        self.assertEqual(data['actors']['age'], 31)
 
     def test_patch_movie_success(self):
         '''Test successfully modifying a movie record'''
@@ -132,6 +693,38 @@ class CastingApiTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(payload['title'], movie.title)
 
+    def test_patch_actor_bad_type(self):
+        '''Test failing modifying an actor with a field of the wrong type'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        response = self.client().patch(f'/actors/{actor_id}',
+                                       headers=headers,
+                                       json={'age': 'old'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['message'], 'age must be an integer')
+        self.assertEqual(Actor.query.get(actor_id).age, 31)
+
+    def test_patch_movie_release_date(self):
+        '''Test modifying the release date of a movie'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_PRODUCER)}'}
+        response = self.client().patch(f'/movies/{movie_id}',
+                                       headers=headers,
+                                       json={'release_date': '2013-01-01'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Movie.query.get(movie_id).release_date,
+                         datetime(2013, 1, 1))
+
+        response = self.client().patch(f'/movies/{movie_id}',
+                                       headers=headers,
+                                       json={'release_date': 'soon'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['message'],
+                         'release_date must be an ISO 8601 date')
+
     def test_delete_actor_success(self):
         '''Test Successfully removing an actor record'''
         headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
@@ -152,6 +745,86 @@ class CastingApiTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['delete'], movie_id)
 
+    def test_delete_actors_bulk(self):
+        '''Test removing actors in bulk, reporting unknown IDs'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        other_id, = Actor.bulk_insert([{
+            'name': 'Bulk_Gone',
+            'age': 40,
+            'gender': 'm'
+        }])
+
+        response = self.client().delete(
+            f'/actors?ids={actor_id},20000,{other_id},{actor_id}',
+            headers=headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(data['deleted']), [actor_id, other_id])
+        self.assertEqual(data['not_found'], [20000])
+        self.assertEqual(data['total_deleted'], 2)
+        self.assertIsNone(Actor.query.get(other_id))
+
+    def test_delete_movies_bulk(self):
+        '''Test removing movies in bulk'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_PRODUCER)}'}
+        response = self.client().delete(f'/movies?ids={movie_id}',
+                                        headers=headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['deleted'], [movie_id])
+        self.assertEqual(data['not_found'], [])
+        self.assertIsNone(Movie.query.get(movie_id))
+
+    def test_patch_actors_bulk(self):
+        '''Test modifying actors in bulk with per-item errors'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        other_id, = Actor.bulk_insert([{
+            'name': 'Bulk_Other',
+            'age': 40,
+            'gender': 'm'
+        }])
+        payload = [{
+            'id': actor_id,
+            'name': 'Bulk_Renamed'
+        }, {
+            'id': other_id,
+            'age': 41,
+            'gender': 'f'
+        }, {
+            'id': 20000,
+            'age': 50
+        }, {
+            'id': actor_id,
+            'age': 32
+        }, {
+            'id': other_id,
+            'age': 'old'
+        }]
+
+        response = self.client().patch('/actors/bulk',
+                                       headers=headers,
+                                       json=payload)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_updated'], 2)
+        self.assertEqual(data['updated'], [{
+            'id': actor_id,
+            'name': 'Bulk_Renamed',
+            'age': 31,
+            'gender': 'f'
+        }, {
+            'id': other_id,
+            'name': 'Bulk_Other',
+            'age': 41,
+            'gender': 'f'
+        }])
+        self.assertEqual(data['not_found'], [20000])
+        self.assertEqual([error['index'] for error in data['errors']], [3, 4])
+        self.assertEqual(Actor.query.get(other_id).age, 41)
+
     # Tests for error behaviors
     def test_get_actors_not_found(self):
         '''Test failing getting out of range page for actors'''
@@ -171,6 +844,88 @@ class CastingApiTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(data['success'], False)
 
+    def test_get_movies_bad_cursor(self):
+        '''Test failing getting movies after a malformed cursor'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_ASSISTANT)}'}
+        response = self.client().get('/movies?after=oops', headers=headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_movies_cursor_out_of_range(self):
+        '''Test failing getting movies after an ID too large to query'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_ASSISTANT)}'}
+        cursor = encode_cursor(2**64)
+        response = self.client().get(f'/movies?after={cursor}',
+                                     headers=headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_movies_page_out_of_range(self):
+        '''Test failing getting a page past the largest offset'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_ASSISTANT)}'}
+        response = self.client().get('/movies?page=99999999999999999999',
+                                     headers=headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_movies_bad_sort(self):
+        '''Test failing sorting movies by a column not allowed'''
+        response = self.client().get('/movies?sort=-secret')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_actors_bad_filter(self):
+        '''Test failing filtering actors by a non numeric age'''
+        response = self.client().get('/actors?min_age=old')
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_actors_bad_count(self):
+        '''Test failing counting actors in an unknown way'''
+        response = self.client().get('/actors?count=roughly')
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_movie_cast_not_found(self):
+        '''Test failing getting the cast of a missing movie'''
+        response = self.client().get('/movies/100000/cast')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_search_without_words(self):
+        '''Test failing searching for nothing'''
+        response = self.client().get('/search?q=%25%25')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_movies_unknown_field(self):
+        '''Test failing requesting a field movies don't have'''
+        response = self.client().get('/movies?fields=id,budget')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_movie_not_found(self):
+        '''Test failing getting a movie that doesn't exist'''
+        response = self.client().get('/movies/20000')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+
     def test_delete_actor_not_found(self):
         '''Test removing an actor that doesn't exists'''
         actor_id = 2000
@@ -191,6 +946,17 @@ class CastingApiTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(data['success'], False)
 
+    def test_patch_actor_not_found(self):
+        '''Test modifying an actor that doesn't exist'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        response = self.client().patch('/actors/20000',
+                                       headers=headers,
+                                       json={'name': 'Nobody'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+
     def test_post_actor_bad_data(self):
         '''Test successfully adding new actor'''
         headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
@@ -213,6 +979,63 @@ class CastingApiTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 422)
         self.assertEqual(data['success'], False)
 
+    def test_post_actors_bulk_all_invalid(self):
+        '''Test failing adding actors in bulk when none are valid'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        payload = [{'name': 'Oops'}, 'not an actor']
+
+        response = self.client().post('/actors/bulk',
+                                      headers=headers,
+                                      json=payload)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(len(data['errors']), 2)
+
+    def test_delete_actors_bulk_bad_ids(self):
+        '''Test failing removing actors in bulk without valid IDs'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        for path in ('/actors', '/actors?ids=', '/actors?ids=1,two',
+                     f'/actors?ids={actor_id},99999999999999999999'):
+            response = self.client().delete(path, headers=headers)
+            self.assertEqual(response.status_code, 400, path)
+
+        self.assertIsNotNone(Actor.query.get(actor_id))
+
+    def test_delete_movies_bulk_too_many(self):
+        '''Test failing removing more movies than one batch allows'''
+        self.app.config['MAX_BULK_IDS'] = 2
+        headers = {'Authorization': f'Bearer {str(TOKEN_PRODUCER)}'}
+        response = self.client().delete(f'/movies?ids={movie_id},2,3',
+                                        headers=headers)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertIsNotNone(Movie.query.get(movie_id))
+
+    def test_delete_movies_bulk_not_auth(self):
+        '''Test failing removing movies in bulk without permission'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_ASSISTANT)}'}
+        response = self.client().delete(f'/movies?ids={movie_id}',
+                                        headers=headers)
+
+        self.assertEqual(response.status_code, 403)
+
+    def test_patch_actors_bulk_all_invalid(self):
+        '''Test failing modifying actors in bulk when none are valid'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        payload = [{'name': 'No_Id'}, {'id': actor_id}, 'not an update',
+                   {'id': 2**64, 'name': 'Too_Big'}]
+
+        response = self.client().patch('/actors/bulk',
+                                       headers=headers,
+                                       json=payload)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(len(data['errors']), 4)
+
     def test_patch_actor_bad_payload(self):
         '''Test successfully modifying record for an actor'''
         headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
@@ -272,6 +1095,423 @@ class CastingApiTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 403)
         self.assertEqual(data['success'], False)
 
+    def test_post_movies_bulk_no_permissions(self):
+        '''Test incorrect permissions adding movies in bulk'''
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        payload = [{'title': 'Wilky', 'release_date': '2012-02-13'}]
+
+        response = self.client().post('/movies/bulk',
+                                      headers=headers,
+                                      json=payload)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(data['success'], False)
+
+
+class ResponseCacheBackendTestCase(unittest.TestCase):
+    '''Test case for the response cache backends.'''
+    def test_memory_cache_evicts_least_recently_used(self):
+        '''Test the memory backend stays within its size cap'''
+        cache = MemoryCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_sqlite_cache_shared_between_instances(self):
+        '''Test entries and invalidations are seen by every process'''
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.sqlite')
+            first = SQLiteCache(path=path, max_size=2, ttl=60)
+            second = SQLiteCache(path=path, max_size=2, ttl=60)
+
+            first.set('key', (b'body', {'ETag': '"v1"'}))
+            self.assertEqual(second.get('key'), (b'body', {'ETag': '"v1"'}))
+
+            second.invalidate('actors')
+            self.assertEqual(first.generation('actors'), 1)
+
+            first.set('other', (b'other', {}))
+            first.set('third', (b'third', {}))
+            self.assertEqual(first.size(), 2)
+            self.assertIsNone(second.get('key'))
+
+    def test_sqlite_cache_default_path_is_private(self):
+        '''Test the default cache file is in a directory of mode 0700'''
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': directory}):
+                cache = SQLiteCache(max_size=2, ttl=60)
+
+            self.assertTrue(cache.path.startswith(directory))
+            mode = os.stat(os.path.dirname(cache.path)).st_mode
+            self.assertEqual(mode & 0o777, 0o700)
+
+
+class PoolStatsTestCase(unittest.TestCase):
+    '''Test case for the connection pool telemetry.'''
+    def setUp(self):
+        pool_stats.reset()
+        self.pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'),
+                                   pool_size=1,
+                                   max_overflow=1,
+                                   timeout=0.05)
+
+    def test_saturated_checkouts_counted(self):
+        '''Test checkouts past the pool size and overflow are counted'''
+        first = self.pool.connect()
+        second = self.pool.connect()
+        with self.assertRaises(TimeoutError):
+            self.pool.connect()
+        first.close()
+        second.close()
+        self.pool.connect().close()
+
+        stats = pool_stats.stats(self.pool)
+        self.assertEqual(stats['checkouts'], 3)
+        self.assertEqual(stats['overflow_checkouts'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['peak_checked_out'], 2)
+        self.assertGreaterEqual(stats['wait_seconds_max'], 0.05)
+        self.assertEqual(stats['checked_out'], 0)
+
+    @requires_server_database
+    def test_pool_configured_from_app_config(self):
+        '''Test the app's pool is sized from the DB_* config'''
+        app = create_app({'DB_POOL_SIZE': 2, 'DB_MAX_OVERFLOW': 3})
+        client = app.test_client()
+        client.get('/movies')
+        stats = json.loads(client.get('/pool/stats').data)['pool']
+
+        self.assertEqual(stats['pool'], 'TimedQueuePool')
+        self.assertEqual((stats['size'], stats['max_overflow']), (2, 3))
+        self.assertGreater(stats['checkouts'], 0)
+
+
+class MetricsTestCase(TransactionalTestCase):
+    '''Test case for the Prometheus metrics.'''
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+
+    def sample(self, name, registry=REGISTRY, **labels):
+        return registry.get_sample_value(name, labels) or 0
+
+    def test_request_and_query_metrics(self):
+        '''Test a request is counted with the statements it ran'''
+        labels = {'method': 'GET', 'endpoint': 'get_movies', 'status': '404'}
+        requests = self.sample('http_requests_total', **labels)
+        queries = self.sample('db_queries_total', endpoint='get_movies')
+
+        self.client.get('/movies?page=100000')
+
+        self.assertEqual(self.sample('http_requests_total', **labels),
+                         requests + 1)
+        self.assertGreater(self.sample('db_queries_total',
+                                       endpoint='get_movies'), queries)
+        response = self.client.get('/metrics')
+        self.assertIn(b'http_request_duration_seconds_bucket', response.data)
+
+    def test_auth_verify_timed(self):
+        '''Test token verifications are timed, cache hits are not'''
+        auth.token_cache.clear()
+        before = self.sample('auth_verify_duration_seconds_count',
+                             outcome='valid')
+        headers = {'Authorization': f'Bearer {str(TOKEN_DIRECTOR)}'}
+        for _ in range(2):
+            self.client.patch('/movies/100000', json={}, headers=headers)
+
+        self.assertEqual(
+            self.sample('auth_verify_duration_seconds_count',
+                        outcome='valid'), before + 1)
+
+    def test_metrics_summed_across_processes(self):
+        '''Test requests served by separate workers are added up'''
+        script = ('from app import create_app; '
+                  'create_app().test_client().get("/cache/stats")')
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, prometheus_multiproc_dir=directory)
+            for _ in range(2):
+                subprocess.run([sys.executable, '-c', script],
+                               env=env,
+                               cwd=ROOT,
+                               check=True)
+
+            registry = CollectorRegistry()
+            MultiProcessCollector(registry, path=directory)
+
+            self.assertEqual(
+                self.sample('http_requests_total',
+                            registry,
+                            method='GET',
+                            endpoint='get_cache_stats',
+                            status='200'), 2)
+
+
+class QueryLogTestCase(TransactionalTestCase):
+    '''Test case for the slow query log and N+1 detector.'''
+    config = {
+        'TESTING': True,
+        'QUERY_LOG': True,
+        'SLOW_QUERY_MS': 0,
+        'N_PLUS_ONE_THRESHOLD': 3
+    }
+
+    def setUp(self):
+        super().setUp()
+
+        @self.app.route('/test/movies/<int:count>')
+        @query_budget(2)
+        def get_movies_one_by_one(count):
+            for id in range(count):
+                Movie.get_row(id)
+            return {'success': True}
+
+        self.client = self.app.test_client()
+
+    def test_statement_shape_ignores_parameters(self):
+        '''Test statements differing only in parameters share a shape'''
+        self.assertEqual(
+            statement_shape('SELECT * FROM movies\n WHERE id IN '
+                            '(%(id_1)s, %(id_2)s)'),
+            statement_shape('SELECT * FROM movies WHERE id IN (%(id_1)s)'))
+
+    def test_repeated_statements_flagged(self):
+        '''Test a statement run once per row is logged as an N+1'''
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            response = self.client.get('/test/movies/2')
+            self.assertEqual(response.headers['X-Query-Count'], '2')
+            self.client.get('/test/movies/3')
+
+        self.assertTrue(any('Slow query' in line for line in logs.output))
+        n_plus_one = [line for line in logs.output if 'N+1' in line]
+        self.assertEqual(len(n_plus_one), 1)
+        self.assertIn('3 x SELECT', n_plus_one[0])
+
+    def test_query_budget_enforced(self):
+        '''Test strict mode fails a route over its query budget'''
+        self.app.config['QUERY_BUDGET_STRICT'] = True
+
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get('/test/movies/3')
+
+
+class StartupTestCase(unittest.TestCase):
+    '''Test case for importing and creating the app.'''
+    def test_import_has_no_side_effects(self):
+        '''Test the modules import without settings, keys or a database'''
+        script = ('import app, auth, models; '
+                  'assert auth.key_source is None; '
+                  'assert models.db.app is None')
+        env = dict(os.environ)
+        env.pop('DATABASE_URL', None)
+        subprocess.run([sys.executable, '-c', script],
+                       env=env,
+                       cwd=ROOT,
+                       check=True)
+
+    def test_create_app_does_not_connect(self):
+        '''Test the app is created without reaching the database'''
+        app = create_app(
+            {'DATABASE_URL': 'postgresql://nobody@127.0.0.1:9/missing'})
+        response = app.test_client().get('/cache/stats')
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_create_app_requires_database_url(self):
+        '''Test a missing database URL fails when the app is created'''
+        with mock.patch.dict(os.environ):
+            os.environ.pop('DATABASE_URL')
+            with self.assertRaises(RuntimeError):
+                create_app()
+
+
+class GunicornConfigTestCase(unittest.TestCase):
+    '''Test case for the gunicorn configuration.'''
+    def test_post_fork_disposes_engine(self):
+        '''Test a forked worker does not reuse the master's connections'''
+        app = create_app()
+        with mock.patch.dict(os.environ):
+            config = runpy.run_path(os.path.join(ROOT, 'gunicorn.conf.py'))
+
+        self.assertTrue(config['preload_app'])
+        with app.app_context():
+            db.session.execute('SELECT 1')
+            db.session.remove()
+            pool = db.engine.pool
+            config['post_fork'](None, None)
+
+            self.assertIsNot(db.engine.pool, pool)
+            # NullPool keeps no connections to count
+            if isinstance(db.engine.pool, QueuePool):
+                self.assertEqual(db.engine.pool.checkedin(), 0)
+
+
+class FakeJWKSStore(JWKSStore):
+    '''JWKS store that serves canned responses instead of fetching.'''
+    def __init__(self, responses, **kwargs):
+        super().__init__('https://example.test/.well-known/jwks.json',
+                         **kwargs)
+        self.responses = responses
+        self.fetches = 0
+
+    def fetch(self):
+        response = self.responses[min(self.fetches, len(self.responses) - 1)]
+        self.fetches += 1
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class JWKSStoreTestCase(unittest.TestCase):
+    '''Test case for the cached JWKS key store.'''
+    key_a = {'keys': [{'kid': 'a', 'kty': 'RSA'}]}
+    key_b = {'keys': [{'kid': 'b', 'kty': 'RSA'}]}
+
+    def test_keys_fetched_once(self):
+        '''Test repeated lookups are served from memory'''
+        store = FakeJWKSStore([self.key_a])
+
+        for _ in range(10):
+            self.assertEqual(store.get_key('a')['kid'], 'a')
+
+        self.assertEqual(store.fetches, 1)
+        self.assertEqual(store.stats()['hits'], 10)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        '''Test an unknown kid forces at most one refresh per interval'''
+        store = FakeJWKSStore([self.key_a, self.key_a],
+                              min_refresh_interval=0)
+        store.get_key('a')
+        store.min_refresh_interval = 60
+
+        store.get_key('missing')
+        store.get_key('missing')
+
+        self.assertEqual(store.fetches, 1)
+        self.assertEqual(store.stats()['misses'], 2)
+
+        store.min_refresh_interval = 0
+        store.responses = [self.key_b]
+        self.assertEqual(store.get_key('b')['kid'], 'b')
+        self.assertEqual(store.fetches, 2)
+
+    def test_stale_keys_served_when_refresh_fails(self):
+        '''Test a failed refresh keeps the last good keys'''
+        store = FakeJWKSStore([self.key_a, OSError('IdP down')],
+                              min_refresh_interval=0)
+        store.get_key('a')
+
+        self.assertFalse(store.refresh())
+        self.assertEqual(store.get_key('a')['kid'], 'a')
+        self.assertEqual(store.stats()['refresh_failures'], 1)
+
+
+class OfflineAuthTestCase(unittest.TestCase):
+    '''Test case for verifying tokens without Auth0.'''
+    @classmethod
+    def setUpClass(cls):
+        cls.key_pair = KEY_PAIR
+
+    def test_minted_token_has_role_permissions(self):
+        '''Test a minted token carries the permissions of its role'''
+        token = mint_token('director', signer=self.key_pair)
+        payload = jwt.decode(token,
+                             self.key_pair.jwk,
+                             algorithms=['RS256'],
+                             audience=auth.API_AUDIENCE)
+
+        self.assertIn('patch:movies', payload['permissions'])
+        self.assertNotIn('delete:movies', payload['permissions'])
+
+    def test_auth0_requires_domain_and_audience(self):
+        '''Test the app does not start with Auth0 half configured'''
+        with mock.patch.dict(os.environ):
+            os.environ.pop('AUTH0_DOMAIN', None)
+            with self.assertRaisesRegex(RuntimeError, 'AUTH0_DOMAIN'):
+                create_app({
+                    'AUTH_KEY_SOURCE': 'auth0',
+                    'AUTH0_AUDIENCE': 'casting'
+                })
+
+    def test_jwks_file_verifies_minted_token(self):
+        '''Test verifying a minted token with a JWKS file'''
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as jwks_file:
+            json.dump(self.key_pair.jwks(), jwks_file)
+            jwks_file.flush()
+            previous = auth.key_source
+            set_key_source(JWKSFileStore(jwks_file.name))
+            try:
+                payload = auth.verify_decode_jwt(
+                    mint_token('producer', signer=self.key_pair))
+            finally:
+                set_key_source(previous)
+
+        self.assertIn('delete:movies', payload['permissions'])
+
+    def test_unknown_key_rejected(self):
+        '''Test a token signed by another key pair is rejected'''
+        previous = auth.key_source
+        set_key_source(FakeJWKSStore([{'keys': []}]))
+        try:
+            with self.assertRaises(AuthError) as context:
+                auth.verify_decode_jwt(
+                    mint_token('producer', signer=self.key_pair))
+        finally:
+            set_key_source(previous)
+
+        self.assertEqual(context.exception.status_code, 400)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    '''Test case for the verified token cache.'''
+    def payload(self, ttl=3600, permissions=('get:actors', )):
+        return {'exp': time.time() + ttl, 'permissions': list(permissions)}
+
+    def test_cached_token_hit(self):
+        '''Test a verified token is served from the cache'''
+        cache = TokenCache(max_size=10)
+        cache.put('token', self.payload())
+
+        payload, permissions = cache.get('token')
+
+        self.assertEqual(permissions, frozenset(['get:actors']))
+        self.assertTrue(check_permissions('get:actors', payload, permissions))
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_expired_token_dropped(self):
+        '''Test an expired token is not served from the cache'''
+        cache = TokenCache(max_size=10)
+        cache.put('token', self.payload(ttl=-1))
+
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_least_recently_used_evicted(self):
+        '''Test the cache stays within its size cap'''
+        cache = TokenCache(max_size=2)
+        cache.put('first', self.payload())
+        cache.put('second', self.payload())
+        cache.get('first')
+        cache.put('third', self.payload())
+
+        self.assertIsNone(cache.get('second'))
+        self.assertIsNotNone(cache.get('first'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_cached_permission_missing(self):
+        '''Test a cached token without the permission is rejected'''
+        cache = TokenCache(max_size=10)
+        payload, permissions = cache.put('token', self.payload())
+
+        with self.assertRaises(AuthError) as context:
+            check_permissions('delete:movies', payload, permissions)
+        self.assertEqual(context.exception.status_code, 403)
+
 
 if __name__ == "__main__":
     unittest.main()
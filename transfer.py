@@ -0,0 +1,215 @@
+import csv
+import io
+import json
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import DateTime, Integer, select
+
+from models import db, bump_version, Actor, Movie
+
+# Number of rows read, converted and written per round trip
+CHUNK_SIZE = 10000
+
+FORMATS = ('csv', 'ndjson')
+
+TABLES = {'actors': Actor.__table__, 'movies': Movie.__table__}
+
+
+def is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def get_table(table_name):
+    '''Returns the table to import into or export from.
+
+    Raises:
+        ValueError if the table cannot be imported or exported.
+    '''
+    if table_name not in TABLES:
+        raise ValueError(f'Unknown table {table_name}, expected one of '
+                         f'{", ".join(sorted(TABLES))}')
+    return TABLES[table_name]
+
+
+def check_columns(table, columns):
+    '''Raises a ValueError for columns that are not in the table.'''
+    unknown = [column for column in columns if column not in table.c]
+    if unknown:
+        raise ValueError(f'Unknown columns for {table.name}: '
+                         f'{", ".join(unknown)}')
+
+
+def chunks(iterable, size=CHUNK_SIZE):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def read_records(in_file, fmt):
+    '''Returns the column names and an iterator of row value lists.'''
+    if fmt == 'csv':
+        reader = csv.reader(in_file)
+        columns = next(reader, [])
+        return columns, reader
+
+    lines = (line for line in in_file if line.strip())
+    first_line = next(lines, None)
+    if first_line is None:
+        return [], iter(())
+
+    first = json.loads(first_line)
+    columns = list(first)
+
+    def records():
+        yield [first.get(column) for column in columns]
+        for line in lines:
+            item = json.loads(line)
+            yield [item.get(column) for column in columns]
+
+    return columns, records()
+
+
+def convert(table, columns, record):
+    '''Converts CSV/JSON values into Python values for the columns.'''
+    row = {}
+    for column, value in zip(columns, record):
+        if value == '' or value is None:
+            row[column] = None
+        elif isinstance(table.c[column].type, Integer):
+            row[column] = int(value)
+        elif isinstance(table.c[column].type, DateTime):
+            row[column] = datetime.fromisoformat(value)
+        else:
+            row[column] = value
+    return row
+
+
+def import_table(table_name, in_file, fmt):
+    '''Loads CSV or NDJSON rows into a table in one transaction.
+
+    CSV files need a header row and NDJSON objects are read with the
+    keys of the first line. On PostgreSQL rows are loaded with COPY ...
+    FROM STDIN; other databases get batched INSERTs of CHUNK_SIZE rows.
+    Rows with an id keep it, and the ID sequence is moved past them.
+
+    Returns:
+        The number of rows imported.
+    '''
+    table = get_table(table_name)
+    columns, records = read_records(in_file, fmt)
+    check_columns(table, columns)
+    if not columns:
+        return 0
+
+    if is_postgres():
+        count = copy_from(table, columns, records)
+    else:
+        count = insert_chunks(table, columns, records)
+
+    return count
+
+
+def copy_from(table, columns, records):
+    # COPY runs on the session's connection, so the rows are committed
+    # or rolled back together with the rest of the session
+    cursor = db.session.connection().connection.cursor()
+    count = 0
+    try:
+        statement = (f'COPY {table.name} ({", ".join(columns)}) '
+                     'FROM STDIN WITH (FORMAT csv)')
+        for chunk in chunks(records):
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(chunk)
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+            count += len(chunk)
+
+        if 'id' in columns:
+            cursor.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f'(SELECT max(id) FROM {table.name}))')
+        bump_version(table.name, row_delta=count)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return count
+
+
+def insert_chunks(table, columns, records):
+    count = 0
+    try:
+        for chunk in chunks(records):
+            rows = [convert(table, columns, record) for record in chunk]
+            db.session.execute(table.insert(), rows)
+            count += len(rows)
+        bump_version(table.name, row_delta=count)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return count
+
+
+def export_table(table_name, out_file, fmt):
+    '''Writes every row of a table, ordered by ID, as CSV or NDJSON.
+
+    On PostgreSQL rows are written with COPY ... TO STDOUT; other
+    databases are read through a server-side cursor CHUNK_SIZE rows at
+    a time. Dates are written in ISO 8601 format either way.
+
+    Returns:
+        The number of rows exported.
+    '''
+    table = get_table(table_name)
+    columns = [column.name for column in table.columns]
+
+    if is_postgres():
+        return copy_to(table, columns, out_file, fmt)
+    return select_chunks(table, columns, out_file, fmt)
+
+
+def copy_to(table, columns, out_file, fmt):
+    query = f'SELECT {", ".join(columns)} FROM {table.name} ORDER BY id'
+    if fmt == 'csv':
+        statement = f'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)'
+    else:
+        # Quote and delimiter characters that never occur in JSON text,
+        # so each row_to_json document is written out verbatim
+        statement = (f'COPY (SELECT row_to_json(t) FROM ({query}) t) '
+                     "TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', "
+                     "DELIMITER E'\\x02')")
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(statement, out_file)
+    return cursor.rowcount
+
+
+def select_chunks(table, columns, out_file, fmt):
+    statement = select([table.c[column] for column in columns]).order_by(
+        table.c.id).execution_options(stream_results=True)
+    result = db.session.execute(statement)
+
+    if fmt == 'csv':
+        writer = csv.writer(out_file)
+        writer.writerow(columns)
+
+    count = 0
+    for chunk in iter(lambda: result.fetchmany(CHUNK_SIZE), []):
+        for record in chunk:
+            if fmt == 'csv':
+                writer.writerow(record)
+            else:
+                values = [
+                    value.isoformat() if isinstance(value, datetime) else
+                    value for value in record
+                ]
+                out_file.write(json.dumps(dict(zip(columns, values))) + '\n')
+        count += len(chunk)
+
+    return count